@@ -33,6 +33,8 @@ def makecalc():
 
     images = retrieve(
         _model, img_embs, c, l,
+        rerank_k=data.get_json().get('rerank_k'),
+        quantized=quantized_img_embs,
     )
 
     imgs = []
@@ -56,8 +58,9 @@ from lavse.data import loaders
 from lavse.data import collate_fns
 from lavse.data import adapters
 from lavse.model import similarity
+from lavse.model.similarity.quantized import QuantizedEmbeddings
 from lavse.model import LAVSE, lavse
-from lavse.train.evaluation import predict_loader
+from lavse.train.evaluation import predict_loader, retrieve_images
 from lavse.utils.logger import create_logger
 from pathlib import Path
 import numpy as np
@@ -66,7 +69,10 @@ from PIL import Image
 logger = create_logger(
     level='info')
 
-device = torch.device('cuda')
+# e.g., LAVSE_DEVICE=cpu on CPU-only nodes (int8 search of Cosine models)
+device = torch.device(os.environ.get('LAVSE_DEVICE', 'cuda'))
+# Shortlist size rescored in float32 after the int8 search (0: no rescoring)
+rescore_k = int(os.environ.get('LAVSE_RESCORE_K', 0)) or None
 
 model_path = Path('../logs/m30k_precomp.en-de/liwe-adamax/')
 
@@ -127,10 +133,39 @@ from torchvision import transforms
 
 transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256)])
 
-def retrieve(model, img_emb, cap_emb, lens):
+def retrieve(model, img_emb, cap_emb, lens, rerank_k=None, quantized=None):
+    '''
+        rerank_k: shortlist the top rerank_k images by pooled cosine
+            similarity and only score them with model.similarity
+        quantized: QuantizedEmbeddings of the images (Cosine models on
+            CPU), searched with int8 scores (rescored in float32 with
+            LAVSE_RESCORE_K)
+    '''
+    if quantized is not None:
+        cap_emb = torch.as_tensor(cap_emb).float()
+        _, index = quantized.search(cap_emb, k=3, rescore_k=rescore_k)
+        image_ids = dataset.ids[index[0].numpy() * 5]
+        return [
+            Image.open(f30k_path / f30k.get_filename_by_image_id(img_id))
+            for img_id
+            in image_ids
+        ]
+
     img_emb = torch.tensor(img_emb).clone().detach().to(device)
     cap_emb = torch.tensor(cap_emb).clone().detach().to(device)
 
+    if rerank_k:
+        index, _ = retrieve_images(
+            model.similarity, img_emb, cap_emb, lens, rerank_k,
+        )
+        idxs = index[0, :3].cpu().numpy() * 5
+        image_ids = dataset.ids[idxs]
+        return [
+            Image.open(f30k_path / f30k.get_filename_by_image_id(img_id))
+            for img_id
+            in image_ids
+        ]
+
     sim = model.compute_pairwise_similarity(
         model.similarity, img_emb, cap_emb, lens,
         shared_size=256
@@ -167,6 +202,17 @@ with torch.no_grad():
     img_embs = torch.tensor(img_embs).to(device).float()
     img_embs = img_embs.to(device).float()
 
+    # CPU-only nodes serving Cosine models search int8 image embeddings,
+    # the float32 copy is only kept to rescore shortlists
+    quantized_img_embs = None
+    if device.type == 'cpu' and isinstance(_model.similarity, similarity.Cosine):
+        quantized_img_embs = QuantizedEmbeddings(
+            img_embs, keep_float=rescore_k is not None,
+        )
+        # Only the int8 codes (and scales) stay in memory
+        img_embs = None
+        logger.info(f'Searching {quantized_img_embs}')
+
 
 
 if __name__ == '__main__':
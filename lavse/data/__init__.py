@@ -1,5 +1,6 @@
 from . import collate_fns
 from . import datasets
 from . import loaders
+from . import samplers
 from . import tokenizer
 from . import adapters
@@ -95,7 +95,9 @@ class Collate:
         attributes = data[0].keys()
 
         batch = Dict()
-        if len(data[0]['caption']) == 2:
+        if 'caption' not in attributes:
+            pass
+        elif len(data[0]['caption']) == 2:
             words, chars = zip(*[x['caption'] for x in data])
             words = default_padding(words)
             char = liwe_padding(chars)
@@ -68,16 +68,21 @@ class Birds(Dataset):
         if data_split in ['test', 'dev']:
             self.n = 10000
 
-    def __getitem__(self, ix):
+    def get_image(self, ix):
         img_id = ix//self.captions_per_image
         img = Image.fromarray(self.images[img_id]).convert('RGB')
         if self.transform is not None:
             img = self.transform(img)
+        return img, img_id
 
-        fname = self.fnames[ix//self.captions_per_image]
-
+    def get_caption(self, ix):
         caption = self.captions[ix]
         tokens = [self.tokenizer(caption)]
+        return tokens
+
+    def __getitem__(self, ix):
+        img, img_id = self.get_image(ix)
+        tokens = self.get_caption(ix)
 
         batch = Dict(
             image=img,
@@ -170,12 +175,14 @@ class PrecompDataset(Dataset):
     def get_img_dim(self):
         return self.images.shape[-1]
 
-    def __getitem__(self, index):
+    def get_image(self, index):
         # handle the image redundancy
         img_id = index//self.im_div
         image = self.images[img_id]
         image = torch.FloatTensor(image)
+        return image, img_id
 
+    def get_caption(self, index):
         # caption = self.precomp_captions[index]
         caption = self.captions[index]
 
@@ -183,6 +190,11 @@ class PrecompDataset(Dataset):
         for tokenizer in self.tokenizers:
             tokens = tokenizer(caption)
             ret_caption.append(tokens)
+        return ret_caption
+
+    def __getitem__(self, index):
+        image, img_id = self.get_image(index)
+        ret_caption = self.get_caption(index)
 
         batch = Dict(
             image=image,
@@ -403,15 +415,22 @@ class ImageDataset(Dataset):
 
         return image
 
-    def __getitem__(self, index):
+    def get_image(self, index):
         # handle the image redundancy
         seq_id = self.ids[index]
         image_id = self.data_wrapper.image_ids[seq_id//5]
 
         image = self.load_img(image_id)
+        return image, image_id
 
+    def get_caption(self, index):
         caption = self.captions[index]
         cap_tokens = [self.tokenizer(caption)]
+        return cap_tokens
+
+    def __getitem__(self, index):
+        image, image_id = self.get_image(index)
+        cap_tokens = self.get_caption(index)
 
         batch = Dict(
             image=image,
@@ -430,3 +449,73 @@ class ImageDataset(Dataset):
 
     def __str__(self):
         return f'{self.data_name}.{self.split}'
+
+
+class ImageView(Dataset):
+    """
+    Iterate over the images of a caption dataset exactly once.
+    Item i is the image of the caption i * captions_per_image.
+    start/end restrict the view to a contiguous range of images.
+    """
+
+    def __init__(self, dataset, start=0, end=None):
+        self.dataset = dataset
+        self.captions_per_image = dataset.captions_per_image
+        n_images = (len(dataset) - 1) // self.captions_per_image + 1
+        if end is None:
+            end = n_images
+        self.start = start
+        self.length = max(min(end, n_images) - start, 0)
+
+    def __getitem__(self, index):
+        cap_index = (self.start + index) * self.captions_per_image
+        if hasattr(self.dataset, 'get_image'):
+            image, img_id = self.dataset.get_image(cap_index)
+        else:
+            instance = self.dataset[cap_index]
+            image, img_id = instance['image'], instance['img_id']
+
+        return Dict(
+            image=image,
+            index=index,
+            img_id=img_id,
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return f'{self.dataset}.images'
+
+
+class CaptionView(Dataset):
+    """
+    Iterate over the captions of a dataset without loading images.
+    start/end restrict the view to a contiguous range of captions.
+    """
+
+    def __init__(self, dataset, start=0, end=None):
+        self.dataset = dataset
+        self.captions_per_image = dataset.captions_per_image
+        if end is None:
+            end = len(dataset)
+        self.start = start
+        self.length = max(min(end, len(dataset)) - start, 0)
+
+    def __getitem__(self, index):
+        cap_index = self.start + index
+        if hasattr(self.dataset, 'get_caption'):
+            caption = self.dataset.get_caption(cap_index)
+        else:
+            caption = self.dataset[cap_index]['caption']
+
+        return Dict(
+            caption=caption,
+            index=index,
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return f'{self.dataset}.captions'
@@ -7,6 +7,7 @@ from torch.utils.data import DataLoader, Dataset
 from . import collate_fns
 from . import datasets
 from . import preprocessing
+from .samplers import HardNegativeBatchSampler
 from .tokenizer import Tokenizer
 from ..utils.file_utils import read_txt
 from ..utils.logger import get_logger
@@ -61,8 +62,12 @@ def get_loader(
     loader_name, data_path, data_name, data_split,
     batch_size, vocab_paths, text_repr,
     lang='en', workers=4, ngpu=1, local_rank=0,
-    cnn=None, **kwargs
+    cnn=None, sampler=None, sampler_params={}, **kwargs
 ):
+    """
+    sampler: 'hard_negative' batches semantically close images together
+        (see samplers.HardNegativeBatchSampler, built with sampler_params)
+    """
 
     logger.debug('Get loader')
     dataset_class = get_dataset_class(loader_name)
@@ -89,10 +94,10 @@ def get_loader(
     )
     logger.debug(f'Dataset built: {dataset}')
 
-    sampler = None
+    data_sampler = None
     shuffle = (data_split == 'train')
     if ngpu > 1:
-        sampler = torch.utils.data.distributed.DistributedSampler(
+        data_sampler = torch.utils.data.distributed.DistributedSampler(
             dataset,
             num_replicas=ngpu,
             rank=local_rank,
@@ -106,6 +111,23 @@ def get_loader(
     if loader_name == 'lang' and text_repr == 'word':
         collate = collate_fns.collate_lang_word
 
+    if sampler == 'hard_negative':
+        batch_sampler = HardNegativeBatchSampler(
+            dataset, batch_size,
+            num_replicas=ngpu, rank=local_rank,
+            eval_transform=preprocessing.get_transform(cnn, 'dev'),
+            **sampler_params
+        )
+        loader = DataLoader(
+            dataset=dataset,
+            batch_sampler=batch_sampler,
+            pin_memory=True,
+            collate_fn=collate,
+            num_workers=workers,
+        )
+        logger.debug(f'Loader built: {loader}')
+        return loader
+
     loader = DataLoader(
         dataset=dataset,
         batch_size=batch_size,
@@ -113,13 +135,49 @@ def get_loader(
         pin_memory=True,
         collate_fn=collate,
         num_workers=workers,
-        sampler=sampler,
+        sampler=data_sampler,
     )
     logger.debug(f'Loader built: {loader}')
 
     return loader
 
 
+def get_image_loader(
+    loader, batch_size=None, workers=None, start=0, end=None,
+):
+    """
+    Sequential loader over the unique images of `loader.dataset`
+    (optionally only the images in [start, end))
+    """
+    dataset = datasets.ImageView(loader.dataset, start=start, end=end)
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size or loader.batch_size,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=loader.collate_fn,
+        num_workers=loader.num_workers if workers is None else workers,
+    )
+
+
+def get_caption_loader(
+    loader, batch_size=None, workers=None, start=0, end=None,
+):
+    """
+    Sequential loader over the captions of `loader.dataset`
+    (optionally only the captions in [start, end))
+    """
+    dataset = datasets.CaptionView(loader.dataset, start=start, end=end)
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size or loader.batch_size,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=loader.collate_fn,
+        num_workers=loader.num_workers if workers is None else workers,
+    )
+
+
 def get_loaders(
         data_path, loader_name, data_name,
         vocab_path, batch_size,
@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from ..utils.logger import get_logger
+
+logger = get_logger()
+
+
+@torch.no_grad()
+def spherical_kmeans(
+    embeddings, n_clusters, n_iter=10, seed=0,
+    device='cpu', block_size=8192,
+):
+    """
+    Cluster assignment of every (n, d) embedding by k-means on the
+    unit sphere (cosine similarity), computed on `device`
+    """
+    x = torch.as_tensor(embeddings, dtype=torch.float32, device=device)
+    x = x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    n_clusters = min(n_clusters, len(x))
+
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(len(x), generator=generator)[:n_clusters]
+    centroids = x[init.to(x.device)]
+
+    assignment = torch.zeros(len(x), dtype=torch.long, device=x.device)
+    for _ in range(n_iter):
+        for start in range(0, len(x), block_size):
+            block = x[start:start + block_size]
+            assignment[start:start + block_size] = block.mm(centroids.t()).argmax(1)
+
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=n_clusters)
+        # Empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty]
+        centroids = centroids / centroids.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+    return assignment.cpu().numpy()
+
+
+@contextmanager
+def transform_override(dataset, transform):
+    """
+    Temporarily replace the image transform of `dataset`, e.g., to
+    embed training images with the deterministic eval transform
+    """
+    if transform is None or not hasattr(dataset, 'transform'):
+        yield dataset
+        return
+
+    train_transform = dataset.transform
+    dataset.transform = transform
+    try:
+        yield dataset
+    finally:
+        dataset.transform = train_transform
+
+
+class HardNegativeBatchSampler(Sampler):
+    """
+    Batches of semantically close images, i.e., harder in-batch
+    negatives than random batches.
+
+    Images are clustered (spherical k-means) from embeddings given to
+    refresh(), e.g., computed by the model at the end of the previous
+    epoch. Every epoch visits each caption once: in each of the
+    captions_per_image rounds, images are laid out cluster by cluster
+    (clusters and images within them shuffled) with one of their
+    captions, and cut into batches. An image never appears twice in
+    a batch. Until the first refresh, batches are random.
+
+    n_clusters: defaults to n_images // batch_size
+    refresh_every: epochs between refreshes (see needs_refresh)
+    num_replicas/rank: each process takes every num_replicas-th batch.
+        As in DistributedSampler, batches are repeated (or dropped with
+        drop_last) so that every rank gets the same number of batches.
+    eval_transform: deterministic image transform used to embed the
+        training images for refresh() (see transform_override)
+    """
+
+    def __init__(
+        self, dataset, batch_size, n_clusters=None, n_iter=10,
+        refresh_every=1, warmup_epochs=1, drop_last=False,
+        num_replicas=1, rank=0, seed=0, eval_transform=None,
+    ):
+        self.batch_size = batch_size
+        self.captions_per_image = getattr(dataset, 'captions_per_image', 1)
+        self.n_images = (len(dataset) - 1) // self.captions_per_image + 1
+        self.n_captions = len(dataset)
+        self.n_clusters = n_clusters or max(self.n_images // batch_size, 1)
+        self.n_iter = n_iter
+        self.refresh_every = refresh_every
+        self.warmup_epochs = warmup_epochs
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.eval_transform = eval_transform
+
+        self.epoch = 0
+        self.clusters = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def needs_refresh(self, epoch):
+        return (
+            epoch >= self.warmup_epochs
+            and (epoch - self.warmup_epochs) % self.refresh_every == 0
+        )
+
+    def refresh(self, img_embeddings, device='cpu'):
+        """
+        Recluster the images from their (n_images, d) embeddings
+        """
+        self.clusters = spherical_kmeans(
+            img_embeddings, self.n_clusters, n_iter=self.n_iter,
+            seed=self.seed + self.epoch, device=device,
+        )
+        sizes = np.bincount(self.clusters, minlength=self.n_clusters)
+        logger.info((
+            f'Hard negative sampler: {self.n_images} images in '
+            f'{(sizes > 0).sum()} clusters (largest: {sizes.max()})'
+        ))
+
+    def _image_order(self, rng):
+        if self.clusters is None:
+            return rng.permutation(self.n_images)
+
+        order = rng.permutation(self.n_images)
+        cluster_rank = rng.permutation(self.n_clusters)
+        # Stable sort keeps the shuffled order within each cluster
+        return order[np.argsort(cluster_rank[self.clusters[order]], kind='stable')]
+
+    def _batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        offsets = rng.randint(self.captions_per_image, size=self.n_images)
+
+        batches = []
+        for round_ in range(self.captions_per_image):
+            images = self._image_order(rng)
+            captions = (
+                images * self.captions_per_image
+                + (offsets[images] + round_) % self.captions_per_image
+            )
+            captions = captions[captions < self.n_captions]
+            for start in range(0, len(captions), self.batch_size):
+                batch = captions[start:start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        total = self._batches_per_rank(len(batches)) * self.num_replicas
+        while len(batches) < total:
+            batches += batches[:total - len(batches)]
+        return batches[:total][self.rank::self.num_replicas]
+
+    def _batches_per_rank(self, n_batches):
+        if self.drop_last:
+            return n_batches // self.num_replicas
+        return (n_batches - 1) // self.num_replicas + 1
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        per_round = self.n_images // self.batch_size
+        if not self.drop_last and self.n_images % self.batch_size:
+            per_round += 1
+        return self._batches_per_rank(per_round * self.captions_per_image)
@@ -1,3 +1,5 @@
+from collections import deque
+
 import torch
 import torch.nn as nn
 import numpy as np
@@ -31,15 +33,176 @@ def cosine_sim_numpy(im, s):
     return im.dot(s.T)
 
 
+class _FusedHingeLoss(torch.autograd.Function):
+    """
+    Sum and max-violation hinge terms of both retrieval directions,
+    computed in blocks of rows (caption retrieval) and columns (image
+    retrieval). Only the (batch,) hardest negatives are kept for the
+    backward pass, which recomputes the active hinges block by block.
+    """
+
+    @staticmethod
+    def forward(ctx, scores, margin, k, chunk_size):
+        n = scores.size(0)
+        diagonal = scores.diag()
+        index = torch.arange(n, device=scores.device)
+
+        # Only reduced-precision scores are summed in float32
+        acc_dtype = scores.dtype
+        if acc_dtype in (torch.float16, torch.bfloat16):
+            acc_dtype = torch.float32
+        cost_sum = torch.zeros((), dtype=acc_dtype, device=scores.device)
+        s_max, s_arg = scores.new_empty(n), index.new_empty(n)
+        im_max, im_arg = scores.new_empty(n), index.new_empty(n)
+
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            rows = index[start:end]
+
+            # caption retrieval: negatives of image i in its row
+            cost = (margin + scores[start:end] - diagonal[start:end, None]).clamp_(min=0)
+            cost[rows - start, rows] = 0
+            cost_sum += cost.sum(dtype=acc_dtype)
+            s_max[start:end], s_arg[start:end] = cost.max(1)
+
+            # image retrieval: negatives of caption j in its column
+            cost = (margin + scores[:, start:end] - diagonal[None, start:end]).clamp_(min=0)
+            cost[rows, rows - start] = 0
+            cost_sum += cost.sum(dtype=acc_dtype)
+            im_max[start:end], im_arg[start:end] = cost.max(0)
+
+        ctx.save_for_backward(scores, s_max, s_arg, im_max, im_arg)
+        ctx.margin, ctx.k, ctx.chunk_size = margin, k, chunk_size
+
+        hard_sum = s_max.sum(dtype=acc_dtype) + im_max.sum(dtype=acc_dtype)
+        return (1. - k) * cost_sum + k * hard_sum
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        scores, s_max, s_arg, im_max, im_arg = ctx.saved_tensors
+        margin, k, chunk_size = ctx.margin, ctx.k, ctx.chunk_size
+
+        n = scores.size(0)
+        diagonal = scores.diag()
+        index = torch.arange(n, device=scores.device)
+        grad = torch.zeros_like(scores)
+        # every hinge also depends on the positive pair (diagonal)
+        diag_grad = scores.new_zeros(n)
+
+        if k < 1.:
+            for start in range(0, n, chunk_size):
+                end = min(start + chunk_size, n)
+                rows = index[start:end]
+
+                active = (margin + scores[start:end] - diagonal[start:end, None]) > 0
+                active[rows - start, rows] = False
+                active = active.to(scores.dtype) * (1. - k)
+                grad[start:end] += active
+                diag_grad[start:end] -= active.sum(1)
+
+                active = (margin + scores[:, start:end] - diagonal[None, start:end]) > 0
+                active[rows, rows - start] = False
+                active = active.to(scores.dtype) * (1. - k)
+                grad[:, start:end] += active
+                diag_grad[start:end] -= active.sum(0)
+
+        if k > 0.:
+            active = (s_max > 0).to(scores.dtype) * k
+            grad.index_put_((index, s_arg), active, accumulate=True)
+            diag_grad -= active
+
+            active = (im_max > 0).to(scores.dtype) * k
+            grad.index_put_((im_arg, index), active, accumulate=True)
+            diag_grad -= active
+
+        grad.index_put_((index, index), diag_grad, accumulate=True)
+        return grad * grad_output, None, None, None
+
+
+def fused_hinge_loss(scores, margin, k, chunk_size=256):
+    """
+    Value and gradients of the ContrastiveLoss hinge terms, i.e.,
+    (1 - k) * (sum of violations) + k * (hardest violations), without
+    materializing the expanded diagonals, the cost matrices or the
+    eye mask: O(batch) memory besides one block of chunk_size rows.
+    """
+    return _FusedHingeLoss.apply(scores, float(margin), float(k), chunk_size)
+
+
+def cat_padded(embeddings):
+    """
+    Concatenate (n, d) or (n, length, d) tensors, zero-padding
+    sequences to the longest length
+    """
+    if embeddings[0].dim() == 2:
+        return torch.cat(embeddings, 0)
+
+    max_len = max(x.shape[1] for x in embeddings)
+    return torch.cat([
+        nn.functional.pad(x, (0, 0, 0, max_len - x.shape[1]))
+        for x in embeddings
+    ], 0)
+
+
+class EmbeddingQueue:
+    """
+    FIFO memory of the most recent image and caption embeddings
+    (detached, kept on their training device), used as extra negatives.
+
+    Batches are stored as they come and the oldest pairs are dropped
+    once more than `size` pairs are stored. Word-level embeddings of
+    different lengths are zero-padded when the queue is read.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.batches = deque()
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @torch.no_grad()
+    def enqueue(self, img_embed, cap_embed, lens):
+        self.batches.append((img_embed.detach(), cap_embed.detach(), list(lens)))
+        self.n += len(img_embed)
+
+        while self.n > self.size:
+            img, cap, lens = self.batches.popleft()
+            excess = self.n - self.size
+            self.n -= len(img)
+            if excess < len(img):
+                self.batches.appendleft((img[excess:], cap[excess:], lens[excess:]))
+                self.n += len(img) - excess
+
+    def embeddings(self):
+        """
+        (img_embed, cap_embed, lens) of every stored pair
+        """
+        imgs, caps, lens = zip(*self.batches)
+        return cat_padded(imgs), cat_padded(caps), sum(lens, [])
+
+    def clear(self):
+        self.batches.clear()
+        self.n = 0
+
+
 class ContrastiveLoss(nn.Module):
     """
     Compute contrastive loss
+
+    queue_size: when > 0, the embeddings of the last queue_size pairs
+        are kept in a FIFO queue (self.queue) and scored as extra
+        negatives of the batch queries (see LAVSE.compute_multimodal_loss)
+    fused: compute the loss with fused_hinge_loss in blocks of
+        chunk_size rows (the dense path is used with a queue)
     """
 
     def __init__(
             self, margin=0.2,
             max_violation=True,
             weight=1., beta=0.999,
+            queue_size=0, fused=False, chunk_size=256,
         ):
         super().__init__()
         self.margin = margin
@@ -49,6 +212,11 @@ class ContrastiveLoss(nn.Module):
         self.beta = beta
         self.device = None
 
+        self.queue_size = queue_size
+        self.queue = EmbeddingQueue(queue_size) if queue_size > 0 else None
+        self.fused = fused
+        self.chunk_size = chunk_size
+
         self.iteration = 0
         self.k = 0
 
@@ -65,13 +233,24 @@ class ContrastiveLoss(nn.Module):
             self.k = 1
             return 1.
 
-        self.k = (1.-self.beta**np.float(self.iteration))
+        self.k = (1.-self.beta**float(self.iteration))
         return self.k
 
-    def forward(self, scores ):
+    def forward(self, scores, queue_scores=None):
+        """
+        scores: (batch, batch) image-caption similarities
+        queue_scores: optional (batch images x queued captions,
+            queued images x batch captions) similarities, added as
+            negatives to both the sum and the max-violation terms
+        """
         # compute image-sentence score matrix
         # scores = self.sim(im, s)
 
+        if self.fused and queue_scores is None:
+            k = self.adjust_k()
+            loss = fused_hinge_loss(scores, self.margin, k, self.chunk_size)
+            return loss * self.weight
+
         diagonal = scores.diag().view(scores.size(0), 1)
         d1 = diagonal.expand_as(scores)
         d2 = diagonal.t().expand_as(scores)
@@ -84,12 +263,20 @@ class ContrastiveLoss(nn.Module):
         cost_im = (self.margin + scores - d2).clamp(min=0)
 
         # clear diagonals
-        mask = torch.eye(scores.size(0)) > .5
-        I = mask#.cuda()
-        I = I.to(cost_s.device)
+        I = torch.eye(scores.size(0), dtype=torch.bool, device=scores.device)
         cost_s = cost_s.masked_fill_(I, 0)
         cost_im = cost_im.masked_fill_(I, 0)
 
+        if queue_scores is not None:
+            img_queue_cap, queue_img_cap = queue_scores
+            # queued captions are extra columns, queued images extra rows
+            cost_s = torch.cat([
+                cost_s, (self.margin + img_queue_cap - diagonal).clamp(min=0)
+            ], 1)
+            cost_im = torch.cat([
+                cost_im, (self.margin + queue_img_cap - diagonal.t()).clamp(min=0)
+            ], 0)
+
         cost_s_t = cost_s.sum()
         cost_im_t = cost_im.sum()
 
@@ -114,7 +301,9 @@ class ContrastiveLoss(nn.Module):
             f'similarity_fn={self.sim}, '
             f'weight={self.weight}, '
             f'max_violation={self.max_violation}, '
-            f'beta={self.beta})'
+            f'beta={self.beta}, '
+            f'queue_size={self.queue_size}, '
+            f'fused={self.fused})'
         ))
 
 
@@ -128,6 +317,7 @@ class ContrastiveLossWithSoftmax(nn.Module):
             self, margin=0.2,
             max_violation=True,
             weight=1., beta=0.999, smooth=20,
+            fused=False, chunk_size=256,
         ):
         super().__init__()
         self.margin = margin
@@ -135,6 +325,8 @@ class ContrastiveLossWithSoftmax(nn.Module):
         self.weight = weight
         self.max_violation = max_violation
         self.beta = beta
+        self.fused = fused
+        self.chunk_size = chunk_size
 
         self.loss_softmax = SoftmaxLoss(smooth=smooth)
 
@@ -153,12 +345,17 @@ class ContrastiveLossWithSoftmax(nn.Module):
             self.k = 1
             return 1.
 
-        self.k = (1.-self.beta**np.float(self.iteration))
+        self.k = (1.-self.beta**float(self.iteration))
         return self.k
 
     def forward(self, scores ):
 
         lst = self.loss_softmax(scores)
+        if self.fused:
+            k = self.adjust_k()
+            loss = fused_hinge_loss(scores, self.margin, k, self.chunk_size)
+            return loss * self.weight + lst
+
         diagonal = scores.diag().view(scores.size(0), 1)
         d1 = diagonal.expand_as(scores)
         d2 = diagonal.t().expand_as(scores)
@@ -171,9 +368,7 @@ class ContrastiveLossWithSoftmax(nn.Module):
         cost_im = (self.margin + scores - d2).clamp(min=0)
 
         # clear diagonals
-        mask = torch.eye(scores.size(0)) > .5
-        I = mask#.cuda()
-        I = I.to(cost_s.device)
+        I = torch.eye(scores.size(0), dtype=torch.bool, device=scores.device)
         cost_s = cost_s.masked_fill_(I, 0)
         cost_im = cost_im.masked_fill_(I, 0)
 
@@ -224,10 +419,9 @@ class SoftmaxLoss(nn.Module):
     def forward(self, scores ):
         self.iteration += 1
 
-        scores = scores.cuda()
         scores = scores * self.smooth
 
-        labels = torch.arange(0, len(scores)).cuda().long()
+        labels = torch.arange(0, len(scores), device=scores.device).long()
 
         l_im = self.loss_im(scores, labels)
         l_tx = self.loss_tx(scores.t(), labels)
@@ -1,9 +1,13 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 
 from . import loss
 from ..utils.logger import get_logger
 from .imgenc import get_image_encoder, get_img_pooling
+from .similarity.autotune import get_shard_sizes, parse_memory
 from .similarity.factory import get_similarity_object
 from .similarity.measure import l2norm
 from .txtenc import get_text_encoder, get_txt_pooling
@@ -19,7 +23,8 @@ class LAVSE(nn.Module):
     def __init__(
         self, txt_enc={}, img_enc={}, similarity={},
         ml_similarity={}, criterion={}, ml_criterion={},
-        tokenizers=None, latent_size=1024, **kwargs
+        tokenizers=None, latent_size=1024, train_memory_budget=None,
+        **kwargs
     ):
         super(LAVSE, self).__init__()
         '''
@@ -28,11 +33,14 @@ class LAVSE(nn.Module):
             similarity: similarity object parameters
             criterion: required only for training
             ml_criterion: required only for training
+            train_memory_budget: bytes allowed for the training batch
+                similarity, it is sharded only when exceeding it
         '''
 
         # Flag for distributed dataparallel
         self.master = True
         self.latent_size = latent_size
+        self.train_memory_budget = train_memory_budget
         self.img_enc = get_image_encoder(
             name=img_enc.name,
             latent_size=latent_size,
@@ -135,21 +143,28 @@ class LAVSE(nn.Module):
     # def get_ml_sim_matrix(self, embed_a, embed_b, lens=None):
     #     return self.ml_similarity(embed_a, embed_b, lens)
 
-    def compute_pairwise_similarity(
-        self, similarity, img_embed, cap_embed, lens, shared_size=128
+    def iter_pairwise_similarity(
+        self, similarity, img_embed, cap_embed, lens, shared_size=128,
+        memory_budget=None,
     ):
-    # def forward_shared(self, img_embed, cap_embed, lens, shared_size=128):
-        """
-        Compute pairwise i2t image-caption distance
         """
+        Yield (im_start, cap_start, sim) for every image shard x
+        caption shard block of the pairwise similarity matrix
 
-        #img_embed = img_embed.to(self.device)
-        #cap_embed = cap_embed.to(self.device)
+        cap_embed can be a (n_caption, d) / (n_caption, n_word, d)
+        tensor or RaggedEmbeddings (word embeddings without padding).
+        img_embed can also be RaggedEmbeddings (variable number of
+        regions) for similarities that support it (StackedAttention).
 
-        n_im_shard = (len(img_embed)-1)//shared_size + 1
-        n_cap_shard = (len(cap_embed)-1)//shared_size + 1
-
-        logger.debug('Calculating shared similarities')
+        shared_size: shard size, or (image, caption) shard sizes
+        memory_budget: bytes per block, shard sizes are then chosen
+            from the similarity cost (see similarity.autotune)
+        """
+        img_embed, cap_embed, im_size, cap_size, sim_kwargs = self._pairwise_setup(
+            similarity, img_embed, cap_embed, shared_size, memory_budget,
+        )
+        n_im_shard = (len(img_embed)-1)//im_size + 1
+        n_cap_shard = (len(cap_embed)-1)//cap_size + 1
 
         pbar_fn = lambda x: range(x)
         if self.master and len(img_embed) > 1000:
@@ -159,22 +174,241 @@ class LAVSE(nn.Module):
                 leave=False,
             )
 
-        sim_matrix = torch.zeros(len(img_embed), len(cap_embed)).cpu()
         for i in pbar_fn(n_im_shard):
-            im_start = shared_size*i
-            im_end = min(shared_size*(i+1), len(img_embed))
+            im_start = im_size*i
+            im_end = min(im_size*(i+1), len(img_embed))
+            im = img_embed[im_start:im_end]
+            # Image-side tensors are shared by every caption shard
+            if hasattr(similarity, 'prepare_images'):
+                im = similarity.prepare_images(im)
             for j in range(n_cap_shard):
-                cap_start = shared_size*j
-                cap_end = min(shared_size*(j+1), len(cap_embed))
-                im = img_embed[im_start:im_end]
+                cap_start = cap_size*j
+                cap_end = min(cap_size*(j+1), len(cap_embed))
                 s = cap_embed[cap_start:cap_end]
                 l = lens[cap_start:cap_end]
-                sim = similarity(im, s, l)
-                sim_matrix[im_start:im_end, cap_start:cap_end] = sim
+                sim = similarity(im, s, l, **sim_kwargs)
+                yield im_start, cap_start, sim
+
+    def _pairwise_setup(
+        self, similarity, img_embed, cap_embed, shared_size, memory_budget,
+    ):
+        im_size, cap_size = get_shard_sizes(
+            similarity, img_embed, cap_embed,
+            shared_size=shared_size, memory_budget=memory_budget,
+        )
+
+        # Normalize every embedding once instead of once per block
+        sim_kwargs = {}
+        if hasattr(similarity, 'normalize_inputs'):
+            img_embed, cap_embed = similarity.normalize_inputs(img_embed, cap_embed)
+            sim_kwargs['normalized'] = True
+
+        return img_embed, cap_embed, im_size, cap_size, sim_kwargs
+
+    def threaded_pairwise_similarity(
+        self, similarity, img_embed, cap_embed, lens, sim_matrix,
+        shared_size=128, memory_budget=None, num_workers=4,
+    ):
+        """
+        CPU backend of compute_pairwise_similarity: image shard x
+        caption shard blocks are scored by a pool of `num_workers`
+        threads (torch ops release the GIL), each writing a disjoint
+        slice of sim_matrix.
+
+        The torch intra-op threads are split among the workers to avoid
+        oversubscription, and restored afterwards.
+        """
+        img_embed, cap_embed, im_size, cap_size, sim_kwargs = self._pairwise_setup(
+            similarity, img_embed, cap_embed, shared_size, memory_budget,
+        )
+        n_images, n_captions = len(img_embed), len(cap_embed)
+
+        total_threads = torch.get_num_threads()
+        worker_threads = max(1, total_threads // num_workers)
+
+        def init_worker():
+            torch.set_num_threads(worker_threads)
+
+        def prepare(im_start):
+            im = img_embed[im_start:min(im_start + im_size, n_images)]
+            if hasattr(similarity, 'prepare_images'):
+                im = similarity.prepare_images(im)
+            return im
+
+        def score(im_start, im, cap_start):
+            cap_end = min(cap_start + cap_size, n_captions)
+            sim = similarity(
+                im, cap_embed[cap_start:cap_end],
+                lens[cap_start:cap_end], **sim_kwargs
+            )
+            im_end = im_start + sim.shape[0]
+            sim_matrix[im_start:im_end, cap_start:cap_end] = sim
+
+        im_starts = range(0, n_images, im_size)
+        try:
+            with ThreadPoolExecutor(num_workers, initializer=init_worker) as pool:
+                # Image-side tensors are prepared once per image shard
+                images = list(pool.map(prepare, im_starts))
+                futures = [
+                    pool.submit(score, im_start, im, cap_start)
+                    for im_start, im in zip(im_starts, images)
+                    for cap_start in range(0, n_captions, cap_size)
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            torch.set_num_threads(total_threads)
+
+        return sim_matrix
+
+    def compute_pairwise_similarity(
+        self, similarity, img_embed, cap_embed, lens, shared_size=128,
+        memory_budget=None, output_device='cpu', async_copy=True,
+        num_workers=1,
+    ):
+    # def forward_shared(self, img_embed, cap_embed, lens, shared_size=128):
+        """
+        Compute pairwise i2t image-caption distance
+
+        cap_embed can be a (n_caption, d) / (n_caption, n_word, d)
+        tensor or RaggedEmbeddings (word embeddings without padding)
+
+        shared_size/memory_budget: see iter_pairwise_similarity
+        output_device: device of the returned matrix. When it is the
+            device of the embeddings no copy is made at all.
+        async_copy: when computing on CUDA with a CPU output (and no
+            gradients), blocks are copied back through pinned buffers in
+            a side stream, overlapping similarity compute and transfer.
+        num_workers: when computing on CPU (and no gradients), blocks
+            are scored by this many threads (see
+            threaded_pairwise_similarity)
+        """
+
+        #img_embed = img_embed.to(self.device)
+        #cap_embed = cap_embed.to(self.device)
+
+        logger.debug('Calculating shared similarities')
+
+        output_device = torch.device(output_device)
+        compute_device = img_embed.device
+        use_writer = (
+            async_copy and compute_device.type == 'cuda'
+            and output_device.type == 'cpu'
+            and not torch.is_grad_enabled()
+        )
+        # Every cell is written by exactly one block, no need to zero it.
+        # Only the writer staging buffers are pinned, the matrix is not.
+        sim_matrix = torch.empty(
+            len(img_embed), len(cap_embed), device=output_device,
+        )
+
+        writer = None
+        if (
+            num_workers > 1 and compute_device.type == 'cpu'
+            and output_device.type == 'cpu'
+            and not torch.is_grad_enabled()
+        ):
+            sim_matrix = self.threaded_pairwise_similarity(
+                similarity, img_embed, cap_embed, lens, sim_matrix,
+                shared_size=shared_size, memory_budget=memory_budget,
+                num_workers=num_workers,
+            )
+            logger.debug('Done computing shared similarities.')
+            return sim_matrix
+
+        if use_writer:
+            im_size, cap_size = get_shard_sizes(
+                similarity, img_embed, cap_embed,
+                shared_size=shared_size, memory_budget=memory_budget,
+            )
+            writer = AsyncHostWriter(
+                sim_matrix, compute_device, max_block=im_size*cap_size
+            )
+
+        for im_start, cap_start, sim in self.iter_pairwise_similarity(
+            similarity, img_embed, cap_embed, lens,
+            shared_size=shared_size, memory_budget=memory_budget,
+        ):
+            if writer is not None:
+                writer.write(sim, im_start, cap_start)
+                continue
+            im_end = im_start + sim.shape[0]
+            cap_end = cap_start + sim.shape[1]
+            sim_matrix[im_start:im_end, cap_start:cap_end] = sim
+
+        if writer is not None:
+            writer.close()
 
         logger.debug('Done computing shared similarities.')
         return sim_matrix
 
+    def batch_similarity(
+        self, similarity, img_embed, cap_embed, lens, memory_budget=None,
+    ):
+        """
+        Training-path similarity: the (n_img, n_cap) matrix of a batch
+        in a single call on the device of the embeddings, so the loss
+        backpropagates through one graph without host round trips.
+
+        It is only computed in shards (concatenated on the device) when
+        the whole batch exceeds memory_budget bytes (see pair_cost).
+        """
+        memory_budget = parse_memory(memory_budget)
+        if memory_budget is not None and hasattr(similarity, 'pair_cost'):
+            pair_bytes, img_bytes, cap_bytes = similarity.pair_cost(
+                img_embed, cap_embed
+            )
+            n_img, n_cap = len(img_embed), len(cap_embed)
+            cost = n_img * n_cap * pair_bytes + n_img * img_bytes + n_cap * cap_bytes
+            if cost > memory_budget:
+                rows = {}
+                for im_start, _, sim in self.iter_pairwise_similarity(
+                    similarity, img_embed, cap_embed, lens,
+                    memory_budget=memory_budget,
+                ):
+                    rows.setdefault(im_start, []).append(sim)
+                return torch.cat([
+                    torch.cat(rows[im_start], 1) for im_start in sorted(rows)
+                ], 0)
+
+        return similarity(img_embed, cap_embed, lens)
+
+    def compute_multimodal_loss(self, img_emb, cap_emb, lens):
+        """
+        Multimodal loss of a batch of embeddings
+
+        When the criterion keeps a queue of past embeddings (e.g.,
+        ContrastiveLoss with queue_size), batch images are also scored
+        against queued captions and queued images against batch
+        captions, then the batch is enqueued.
+        """
+        sim_matrix = self.batch_similarity(
+            self.similarity, img_emb, cap_emb, lens,
+            memory_budget=self.train_memory_budget,
+        )
+
+        queue = getattr(self.multimodal_criterion, 'queue', None)
+        if queue is None:
+            return self.multimodal_criterion(sim_matrix)
+
+        queue_scores = None
+        if len(queue) > 0:
+            queue_img, queue_cap, queue_lens = queue.embeddings()
+            queue_scores = (
+                self.batch_similarity(
+                    self.similarity, img_emb, queue_cap, queue_lens,
+                    memory_budget=self.train_memory_budget,
+                ),
+                self.batch_similarity(
+                    self.similarity, queue_img, cap_emb, lens,
+                    memory_budget=self.train_memory_budget,
+                ),
+            )
+
+        loss = self.multimodal_criterion(sim_matrix, queue_scores=queue_scores)
+        queue.enqueue(img_emb, cap_emb, lens)
+        return loss
+
     # def loss(self, batch):
 
     #     loss_values = {}
@@ -186,10 +420,7 @@ class LAVSE(nn.Module):
         img_emb, cap_emb = self.forward_batch(batch)
         _, lens = batch['caption']
 
-        sim_matrix = self.compute_pairwise_similarity(
-            self.similarity, img_emb, cap_emb, lens)
-
-        loss = self.multimodal_criterion(sim_matrix)
+        loss = self.compute_multimodal_loss(img_emb, cap_emb, lens)
 
         # cap_vec = pooling.last_hidden_state_pool(cap_emb, lens)
         # sim_global = self.model.cosine.forward_shared(
@@ -213,14 +444,67 @@ class LAVSE(nn.Module):
             cap_a_embed = pooling.last_hidden_state_pool(cap_a_embed, lens_a)
             cap_b_embed = pooling.last_hidden_state_pool(cap_b_embed, lens_b)
 
-        sim_matrix = self.compute_pairwise_similarity(
-            self.ml_similarity, cap_a_embed, cap_b_embed, lens_b
+        sim_matrix = self.batch_similarity(
+            self.ml_similarity, cap_a_embed, cap_b_embed, lens_b,
+            memory_budget=self.train_memory_budget,
         )
         loss = self.multilanguage_criterion(sim_matrix)
 
         return loss
 
 
+class AsyncHostWriter:
+    """
+    Copies similarity blocks from a CUDA device into a host
+    matrix without blocking the computation of the next blocks.
+
+    Each block is copied into a pinned staging buffer in a side stream.
+    The host-side copy into the matrix only waits for the oldest block
+    when all staging buffers are in use.
+    """
+
+    def __init__(self, sim_matrix, device, max_block, n_buffers=4):
+        self.sim_matrix = sim_matrix
+        self.device = device
+        self.max_block = max_block
+        self.stream = torch.cuda.Stream(device)
+        self.free_buffers = [
+            torch.empty(max_block, dtype=sim_matrix.dtype, pin_memory=True)
+            for _ in range(n_buffers)
+        ]
+        self.pending = deque()
+
+    def write(self, sim, im_start, cap_start):
+        if not self.free_buffers:
+            self._flush_one()
+
+        buffer = self.free_buffers.pop()
+        h, w = sim.shape
+        staging = buffer[:h*w].view(h, w)
+
+        # Wait for the similarity kernel before copying its output
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            staging.copy_(sim.to(staging.dtype), non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        # Prevent the caching allocator from reusing sim too early
+        sim.record_stream(self.stream)
+
+        self.pending.append((event, buffer, staging, im_start, cap_start))
+
+    def _flush_one(self):
+        event, buffer, staging, im_start, cap_start = self.pending.popleft()
+        event.synchronize()
+        h, w = staging.shape
+        self.sim_matrix[im_start:im_start+h, cap_start:cap_start+w] = staging
+        self.free_buffers.append(buffer)
+
+    def close(self):
+        while self.pending:
+            self._flush_one()
+
+
 def lavse(model_path, tokenizers):
     from addict import Dict
     state_dict = torch.load(
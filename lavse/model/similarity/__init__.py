@@ -2,3 +2,5 @@ from .similarity import *
 from . import similarity
 from . import measure
 from . import factory
+from . import autotune
+from . import quantized
@@ -0,0 +1,106 @@
+import numpy as np
+
+from ...utils.logger import get_logger
+
+logger = get_logger()
+
+# (similarity, device, memory_budget, n_images, n_captions, pair_cost)
+#   -> (img_shard_size, cap_shard_size)
+_shard_sizes = {}
+
+
+def parse_memory(memory_budget):
+    """
+    Memory budget in bytes. Accepts numbers or strings such as
+    '1e9' (as yaml may load them) or '512MB'/'2GB'.
+    """
+    if memory_budget is None:
+        return None
+    if isinstance(memory_budget, str):
+        units = {'KB': 2**10, 'MB': 2**20, 'GB': 2**30}
+        value = memory_budget.strip().upper()
+        for unit, scale in units.items():
+            if value.endswith(unit):
+                return int(float(value[:-len(unit)]) * scale)
+        return int(float(value))
+    return int(memory_budget)
+
+
+def autotune_shard_sizes(
+    similarity, img_embed, cap_embed, memory_budget,
+    min_size=8,
+):
+    """
+    Image and caption shard sizes that keep the intermediate tensors
+    of one similarity block within `memory_budget` bytes.
+
+    The cost comes from similarity.pair_cost(img_embed, cap_embed), that
+    returns the bytes used per (image, caption) pair, per image and per
+    caption. The choice is cached for each similarity, device, number
+    of images/captions and cost (i.e., shapes and dtype). A warning is
+    logged when even min_size x min_size blocks exceed the budget.
+    """
+    memory_budget = parse_memory(memory_budget)
+    n_images, n_captions = len(img_embed), len(cap_embed)
+    pair_bytes, img_bytes, cap_bytes = similarity.pair_cost(
+        img_embed, cap_embed
+    )
+
+    key = (
+        similarity, str(img_embed.device), memory_budget,
+        n_images, n_captions, (pair_bytes, img_bytes, cap_bytes),
+    )
+    if key in _shard_sizes:
+        return _shard_sizes[key]
+
+    min_img = max(min(min_size, n_images), 1)
+    min_cap = max(min(min_size, n_captions), 1)
+
+    # Square blocks, shrunk so that at least min_cap captions still fit
+    img_size = int(np.sqrt(memory_budget / pair_bytes))
+    img_size = int(np.clip(img_size, min_img, max(n_images, min_img)))
+    max_img = (memory_budget - min_cap * cap_bytes) // (img_bytes + min_cap * pair_bytes)
+    img_size = int(min(img_size, max_img))
+
+    if img_size < min_img:
+        img_size, cap_size = min_img, min_cap
+        block = img_size * img_bytes + cap_size * (cap_bytes + img_size * pair_bytes)
+        logger.warning((
+            f'Memory budget of {memory_budget/2**20:.1f}MB is too small for '
+            f'{type(similarity).__name__}, using {img_size}x{cap_size} '
+            f'blocks ({block/2**20:.1f}MB)'
+        ))
+    else:
+        # Spend what is left on the caption side
+        # (e.g., when all the images fit in a single shard)
+        left = memory_budget - img_size * img_bytes
+        cap_size = int(left // (img_size * pair_bytes + cap_bytes))
+        cap_size = int(min(cap_size, max(n_captions, min_cap)))
+
+    logger.info((
+        f'Shard sizes for {type(similarity).__name__} '
+        f'on {img_embed.device}: images {img_size}, captions {cap_size} '
+        f'(budget {memory_budget/2**20:.0f}MB)'
+    ))
+
+    _shard_sizes[key] = (img_size, cap_size)
+    return img_size, cap_size
+
+
+def get_shard_sizes(
+    similarity, img_embed, cap_embed,
+    shared_size=128, memory_budget=None,
+):
+    """
+    (img_shard_size, cap_shard_size) from a fixed size, a pair of
+    sizes, or the memory budget when given
+    """
+    if memory_budget is not None and hasattr(similarity, 'pair_cost'):
+        return autotune_shard_sizes(
+            similarity, img_embed, cap_embed, memory_budget,
+        )
+
+    if isinstance(shared_size, (tuple, list)):
+        return tuple(shared_size)
+
+    return shared_size, shared_size
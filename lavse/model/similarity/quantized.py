@@ -0,0 +1,177 @@
+import numpy as np
+import torch
+
+from ...utils.logger import get_logger
+from .measure import l2norm
+
+logger = get_logger()
+
+
+def _to_float_tensor(embeddings):
+    if not torch.is_tensor(embeddings):
+        embeddings = torch.from_numpy(np.ascontiguousarray(embeddings))
+    return embeddings.detach().cpu().float()
+
+
+class QuantizedEmbeddings:
+    """
+    int8 embedding store for CPU cosine retrieval.
+
+    Every vector is stored as int8 codes with its own float scale
+    (symmetric quantization, vector ~= codes * scale), i.e., roughly
+    4x less memory than float32. search() scores queries against blocks
+    of the store and keeps a running top-k.
+
+    When a quantized engine (fbgemm/qnnpack) is available, blocks are
+    packed once and scored with int8 GEMMs (dynamic quantized linear,
+    per-vector scales as per-channel weight scales). Otherwise blocks
+    are dequantized on the fly (codes are never expanded as a whole).
+
+    embeddings: (n, d) numpy array or tensor
+    normalize: l2-normalize vectors (and queries), so scores are cosines
+    keep_float: keep the float32 vectors to rescore shortlists exactly
+    """
+
+    def __init__(
+        self, embeddings, block_size=4096, normalize=True,
+        keep_float=False, use_packed=True,
+    ):
+        vectors = _to_float_tensor(embeddings)
+        if normalize:
+            vectors = l2norm(vectors, dim=1)
+
+        self.normalize = normalize
+        self.block_size = block_size
+        self.n, self.dim = vectors.shape
+
+        self.scales = (vectors.abs().max(1)[0] / 127.).clamp(min=1e-12)
+        self.codes = torch.round(
+            vectors / self.scales.unsqueeze(1)
+        ).clamp(-127, 127).to(torch.int8)
+        self.vectors = vectors if keep_float else None
+
+        self.packed = None
+        if use_packed:
+            self.packed = self._pack()
+        if self.packed is not None:
+            # Packed blocks already hold the codes
+            self.codes = None
+
+    def _pack(self):
+        try:
+            packed = []
+            for start in range(0, self.n, self.block_size):
+                end = min(start + self.block_size, self.n)
+                weight = torch.quantize_per_channel(
+                    self.codes[start:end].float() * self.scales[start:end, None],
+                    scales=self.scales[start:end].double(),
+                    zero_points=torch.zeros(end - start, dtype=torch.long),
+                    axis=0, dtype=torch.qint8,
+                )
+                packed.append(torch.ops.quantized.linear_prepack(weight, None))
+            return packed
+        except (RuntimeError, AttributeError) as e:
+            logger.info(f'Quantized engine unavailable, dequantizing blocks ({e})')
+            return None
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """
+        Memory of the codes and scales (float vectors excluded)
+        """
+        return self.n * self.dim + self.scales.numel() * 4
+
+    def block_codes(self, block):
+        """
+        int8 codes of the block-th block of vectors
+        """
+        if self.codes is not None:
+            start = block * self.block_size
+            return self.codes[start:start + self.block_size]
+        weight, _ = torch.ops.quantized.linear_unpack(self.packed[block])
+        return weight.int_repr()
+
+    def dequantize(self, index=None):
+        """
+        Float32 approximation of the vectors (or of vectors[index])
+        """
+        n_blocks = (self.n - 1) // self.block_size + 1
+        codes = torch.cat([self.block_codes(b) for b in range(n_blocks)], 0)
+        scales = self.scales
+        if index is not None:
+            codes, scales = codes[index], scales[index]
+        return codes.float() * scales.unsqueeze(-1)
+
+    def _block_scores(self, queries, block):
+        if self.packed is not None:
+            return torch.ops.quantized.linear_dynamic(queries, self.packed[block])
+
+        start = block * self.block_size
+        scales = self.scales[start:start + self.block_size]
+        return queries.mm(self.block_codes(block).float().t()) * scales
+
+    @torch.no_grad()
+    def search(self, queries, k=10, rescore_k=None, vectors=None):
+        """
+        Top-k stored vectors of every query
+
+        queries: (n_queries, d) numpy array or tensor
+        rescore_k: shortlist rescore_k candidates with the int8 scores,
+            then rescore them with the float vectors (keep_float or
+            `vectors`) and keep the best k
+        Returns (scores, index), both (n_queries, k), sorted by
+        decreasing score.
+        """
+        queries = _to_float_tensor(queries)
+        if self.normalize:
+            queries = l2norm(queries, dim=1)
+
+        if rescore_k is not None and rescore_k > k:
+            return self._rescore(queries, k, rescore_k, vectors)
+
+        k = min(k, self.n)
+        n_queries = len(queries)
+        top_scores = torch.full((n_queries, k), -np.inf)
+        top_index = torch.zeros((n_queries, k), dtype=torch.long)
+
+        for block, start in enumerate(range(0, self.n, self.block_size)):
+            scores = self._block_scores(queries, block)
+            block_k = min(k, scores.shape[1])
+            scores, index = scores.topk(block_k, dim=1)
+
+            scores = torch.cat([top_scores, scores], 1)
+            index = torch.cat([top_index, index + start], 1)
+            top_scores, pos = scores.topk(k, dim=1)
+            top_index = index.gather(1, pos)
+
+        return top_scores, top_index
+
+    def _rescore(self, queries, k, rescore_k, vectors=None):
+        if vectors is None:
+            vectors = self.vectors
+        if vectors is None:
+            raise ValueError(
+                'Rescoring requires float vectors (keep_float=True)'
+            )
+        vectors = _to_float_tensor(vectors)
+        if self.normalize:
+            vectors = l2norm(vectors, dim=1)
+
+        _, candidates = self.search(queries, k=rescore_k)
+        # (n_queries, rescore_k, d) x (n_queries, d, 1)
+        scores = torch.bmm(
+            vectors[candidates], queries.unsqueeze(2)
+        ).squeeze(2)
+
+        top_scores, pos = scores.topk(min(k, scores.shape[1]), dim=1)
+        return top_scores, candidates.gather(1, pos)
+
+    def __repr__(self):
+        return (
+            f'QuantizedEmbeddings(n={self.n}, dim={self.dim}, '
+            f'packed={self.packed is not None}, '
+            f'nbytes={self.nbytes/2**20:.1f}MB)'
+        )
@@ -10,6 +10,7 @@ from tqdm import tqdm
 
 from ...utils import helper
 from ...utils.logger import get_logger
+from ...utils.ragged import RaggedEmbeddings
 from .. import txtenc
 from ..layers import attention, condbn, dynconv
 from ..txtenc.pooling import mean_pooling
@@ -22,19 +23,52 @@ logger = get_logger()
 
 class Cosine(nn.Module):
 
-    def __init__(self,):
+    def __init__(self, prenormalized=False, **kwargs):
+        """
+        prenormalized: inputs are already unit vectors (e.g., encoders
+            with no_imgnorm/no_txtnorm False), never normalize them
+        """
         super().__init__()
-        pass
+        self.prenormalized = prenormalized
+
+    def normalize_inputs(self, img_embed, cap_embed):
+        """
+        Normalize-once stage: pairwise drivers normalize the whole
+        embedding matrices here, then call forward(normalized=True)
+        for every shard, so the shard loop is a pure matmul.
+        """
+        if self.prenormalized:
+            return img_embed, cap_embed
+        return l2norm(img_embed, dim=1), l2norm(cap_embed, dim=1)
 
-    def forward(self, img_embed, cap_embed, *args, **kwargs):
-        img_embed = l2norm(img_embed, dim=1)
-        cap_embed = l2norm(cap_embed, dim=1)
+    def forward(self, img_embed, cap_embed, *args, normalized=False, **kwargs):
+        if not normalized:
+            img_embed, cap_embed = self.normalize_inputs(img_embed, cap_embed)
 
         return cosine_sim(img_embed, cap_embed)#.cpu()
 
+    def score_pairs(self, img_embed, cap_embed, *args, **kwargs):
+        """
+        Similarity of aligned pairs (img_embed[i], cap_embed[i])
+        """
+        img_embed, cap_embed = self.normalize_inputs(img_embed, cap_embed)
+        return (img_embed * cap_embed).sum(1)
+
+    def __repr__(self):
+        return f'Cosine(prenormalized: {self.prenormalized})'
+
+    def pair_cost(self, img_embed, cap_embed):
+        """
+        Bytes used per (image, caption) pair, per image and per caption
+        """
+        itemsize = img_embed.element_size()
+        latent_size = img_embed.shape[-1]
+        return itemsize, itemsize * latent_size, itemsize * latent_size
+
 
 class LogSumExp(nn.Module):
     def __init__(self, lambda_lse):
+        super().__init__()
         self.lambda_lse = lambda_lse
 
     def forward(self, x):
@@ -49,8 +83,41 @@ class ClippedL2Norm(nn.Module):
         super().__init__()
         self.leaky = nn.LeakyReLU(0.1)
 
-    def forward(self, x):
-        return l2norm(self.leaky(x), 2)
+    def forward(self, x, mask=None, dim=2):
+        x = mask_queries(self.leaky(x), mask, 0.)
+        return l2norm(x, dim)
+
+
+class PreparedEmbeddings:
+    """
+    Padded sequences along with the tensors StackedAttention
+    derives from them (see StackedAttention.prepare_images)
+
+    embeddings: (n, L, d) contiguous padded sequences
+    mask: (n, L) mask of real positions, or None
+    norms: (n, L) norms of every position, or None
+    gram: (n, L, L) Gram matrix of every sequence, or None
+    """
+
+    def __init__(self, embeddings, mask=None, norms=None, gram=None):
+        self.embeddings = embeddings
+        self.mask = mask
+        self.norms = norms
+        self.gram = gram
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __getitem__(self, index):
+        _slice = lambda x: x[index] if x is not None else None
+        return PreparedEmbeddings(
+            self.embeddings[index], _slice(self.mask),
+            _slice(self.norms), _slice(self.gram),
+        )
+
+    @property
+    def device(self):
+        return self.embeddings.device
 
 
 class StackedAttention(nn.Module):
@@ -58,8 +125,13 @@ class StackedAttention(nn.Module):
     def __init__(
         self, i2t=True, agg_function='Mean',
         feature_norm='softmax', lambda_lse=None,
-        smooth=4, **kwargs,
+        smooth=4, chunk_size=None, **kwargs,
     ):
+        """
+        chunk_size: number of images scored at once against a caption
+            shard, bounds the peak memory of forward() regardless of
+            the shard size (default: the whole image shard)
+        """
         super().__init__()
         self.i2t = i2t
         self.lambda_lse = lambda_lse
@@ -67,6 +139,7 @@ class StackedAttention(nn.Module):
         self.feature_norm = feature_norm
         self.lambda_lse = lambda_lse
         self.smooth = smooth
+        self.chunk_size = chunk_size
         self.kwargs = kwargs
 
         self.attention = Attention(
@@ -86,46 +159,232 @@ class StackedAttention(nn.Module):
 
         self.task = 'i2t' if i2t else 't2i'
 
-    def forward(self, images, captions, cap_lens, ):
+    def forward(self, images, captions, cap_lens, img_lens=None):
         """
         Images: (n_image, n_regions, d) matrix of images
+            or RaggedEmbeddings with n_image sequences of regions
         Captions: (n_caption, max_n_word, d) matrix of captions
+            or RaggedEmbeddings with n_caption sequences
         CapLens: (n_caption) array of caption lengths
+        ImgLens: (n_image) array of region counts, None when every
+            image has n_regions real regions
+
+        Images can also be given already prepared (see prepare_images).
+        Images are scored in chunks of chunk_size against every
+        caption. Padded words and regions are masked out.
+        Returns (n_image, n_caption) similarities.
         """
+        if not isinstance(images, PreparedEmbeddings):
+            images = self.prepare_images(images, img_lens)
+        captions = self._prepare(captions, cap_lens, is_query=not self.i2t)
+
+        n_image = len(images)
+        chunk_size = self.chunk_size or max(n_image, 1)
+
         similarities = []
-        n_image = images.size(0)
-        n_caption = captions.size(0)
-
-        for i in range(n_caption):
-            # Get the i-th text description
-            n_word = cap_lens[i]
-            cap_i = captions[i, :n_word, :].unsqueeze(0).contiguous()
-            # --> (n_image, n_word, d)
-            cap_i_expand = cap_i.repeat(n_image, 1, 1)
-            """
-                word(query): (n_image, n_word, d)
-                image(context): (n_image, n_regions, d)
-                weiContext: (n_image, n_word, d) or (n_image, n_region, d)
-                attn: (n_image, n_region, n_word)
-            """
-            emb_a = cap_i_expand
-            emb_b = images
-            if self.i2t:
-                emb_a = images
-                emb_b = cap_i_expand
-
-            weiContext, attn = self.attention(emb_a, emb_b)
-            emb_a = emb_a.contiguous()
-            weiContext = weiContext.contiguous()
-            # (n_image, n_word)
-            row_sim = cosine_similarity(emb_a, weiContext, dim=2)
-            row_sim = self.aggregate_function(row_sim)
-            similarities.append(row_sim)
+        for start in range(0, n_image, chunk_size):
+            end = min(start + chunk_size, n_image)
+            similarities.append(self._score_chunk(images[start:end], captions))
 
         # (n_image, n_caption)
-        similarities = torch.cat(similarities, 1)
+        return torch.cat(similarities, 0)
+
+    def prepare_images(self, images, img_lens=None):
+        """
+        Image-side tensors used by forward(): padded regions, their
+        mask and their norms (i2t) or Gram matrices (t2i).
+
+        Images are attended against many caption shards during
+        evaluation, preparing them once per image shard avoids
+        recomputing these tensors for every caption shard.
+        """
+        return self._prepare(images, img_lens, is_query=self.i2t)
+
+    def _prepare(self, embeddings, lengths, is_query):
+        """
+        Queries need their norms, contexts their Gram matrices
+        """
+        embeddings, mask = self._pad(embeddings, lengths)
+        embeddings = embeddings.contiguous()
 
-        return similarities
+        norms, gram = None, None
+        if is_query:
+            norms = torch.norm(embeddings, 2, 2)
+        else:
+            gram = torch.bmm(embeddings, embeddings.transpose(1, 2))
+        return PreparedEmbeddings(embeddings, mask, norms, gram)
+
+    def _score_chunk(self, images, captions, eps=1e-8):
+        """
+        (n_image, n_caption) similarities of every image x caption pair
+
+        Captions are never repeated per image: the region-word scores
+        of all pairs come from a single matmul and are normalized in
+        place along the region or word axis. The weighted context is not
+        materialized either: its dot product with the query is
+        sum(attn * scores) and its squared norm is the quadratic form
+        of the attention weights with the context Gram matrix. Memory
+        is O(n_image * n_regions * n_caption * n_word), without the
+        latent dimension.
+
+        images, captions: PreparedEmbeddings
+        """
+        region_mask, word_mask = images.mask, captions.mask
+        n_image, n_regions, d = images.embeddings.shape
+        n_caption, n_word = captions.embeddings.shape[:2]
+
+        # --> (n_image, n_regions, n_caption, n_word)
+        scores = torch.mm(
+            images.embeddings.view(-1, d),
+            captions.embeddings.view(-1, d).t(),
+        ).view(n_image, n_regions, n_caption, n_word)
+
+        words = word_mask.view(1, 1, n_caption, n_word)
+        regions = None
+        if region_mask is not None:
+            regions = region_mask.view(n_image, n_regions, 1, 1)
+
+        if self.i2t:
+            # query: regions, context: words
+            attn = self.attention.normalize_attn(scores, regions, dim=1)
+            attn = attn.masked_fill(~words, -np.inf)
+            attn = F.softmax(attn * self.smooth, dim=3)
+
+            # --> (n_image, n_regions, n_caption)
+            w12 = (attn * scores).sum(3)
+            # --> (n_caption, n_image * n_regions, n_word)
+            attn_c = attn.view(-1, n_caption, n_word).transpose(0, 1)
+            # (n_caption, n_word, n_word) Gram matrices of the captions
+            w2 = (torch.bmm(attn_c, captions.gram) * attn_c).sum(2)
+            w2 = w2.t().view(n_image, n_regions, n_caption)
+            w1 = images.norms.unsqueeze(2)
+
+            # --> (n_image, n_caption, n_regions)
+            row_sim = _safe_cosine(w12, w1, w2, eps).transpose(1, 2)
+            query_mask = None
+            if region_mask is not None:
+                query_mask = region_mask.unsqueeze(1).expand(
+                    n_image, n_caption, n_regions
+                )
+        else:
+            # query: words, context: regions
+            attn = self.attention.normalize_attn(scores, words, dim=3)
+            if regions is not None:
+                attn = attn.masked_fill(~regions, -np.inf)
+            attn = F.softmax(attn * self.smooth, dim=1)
+
+            # --> (n_image, n_caption, n_word)
+            w12 = (attn * scores).sum(1)
+            attn_i = attn.view(n_image, n_regions, n_caption * n_word)
+            # (n_image, n_regions, n_regions) Gram matrices of the images
+            w2 = (torch.bmm(images.gram, attn_i) * attn_i).sum(1)
+            w2 = w2.view(n_image, n_caption, n_word)
+            w1 = captions.norms.unsqueeze(0)
+
+            row_sim = _safe_cosine(w12, w1, w2, eps)
+            query_mask = word_mask.unsqueeze(0).expand(
+                n_image, n_caption, n_word
+            )
+
+        queryL = row_sim.shape[-1]
+        if query_mask is not None:
+            query_mask = query_mask.reshape(-1, queryL)
+        row_sim = self.aggregate(row_sim.reshape(-1, queryL), query_mask)
+        return row_sim.view(n_image, n_caption)
+
+    def score_pairs(self, images, captions, cap_lens, img_lens=None):
+        """
+        Similarity of aligned pairs (images[i], captions[i])
+
+        Images: (n, n_regions, d) or RaggedEmbeddings
+        Captions: (n, max_n_word, d) or RaggedEmbeddings
+        Returns (n,) similarities
+        """
+        images, region_mask = self._pad(images, img_lens)
+        captions, word_mask = self._pad(captions, cap_lens)
+        return self._score(images, captions, word_mask, region_mask)
+
+    def _pad(self, embeddings, lengths):
+        """
+        Padded sequences (trimmed to the longest one) and their
+        (n, max_length) mask of real positions. The mask is None when
+        no lengths are given, i.e., every position is real.
+        """
+        if isinstance(embeddings, RaggedEmbeddings):
+            embeddings, lengths = embeddings.pad()
+        elif lengths is None:
+            return embeddings, None
+        else:
+            max_len = int(max(lengths)) if len(lengths) > 0 else 0
+            embeddings = embeddings[:, :max_len]
+
+        mask = lengths_to_mask(lengths, embeddings.shape[1], embeddings.device)
+        return embeddings, mask
+
+    def _score(self, images, captions, word_mask, region_mask=None):
+        """
+            word(query): (batch, n_word, d)
+            image(context): (batch, n_regions, d)
+            weiContext: (batch, n_word, d) or (batch, n_region, d)
+            attn: (batch, n_region, n_word)
+        """
+        query, context = captions, images
+        query_mask, context_mask = word_mask, region_mask
+        if self.i2t:
+            query, context = images, captions
+            query_mask, context_mask = region_mask, word_mask
+
+        weiContext, attn = self.attention(
+            query, context,
+            query_mask=query_mask, context_mask=context_mask,
+        )
+        weiContext = weiContext.contiguous()
+        # (batch, queryL)
+        row_sim = cosine_similarity(query, weiContext, dim=2)
+        row_sim = row_sim.view(query.size(0), query.size(1))
+        row_sim = self.aggregate(row_sim, query_mask)
+        return row_sim.view(-1)
+
+    def aggregate(self, row_sim, mask=None):
+        """
+        Aggregate (batch, queryL) similarities over the real positions
+        """
+        if mask is None:
+            return self.aggregate_function(row_sim)
+
+        if self.agg_function == 'Mean':
+            row_sim = row_sim.masked_fill(~mask, 0.)
+            lengths = mask.sum(dim=1, keepdim=True).type_as(row_sim)
+            return row_sim.sum(dim=1, keepdim=True) / lengths
+        if self.agg_function == 'Sum':
+            return self.aggregate_function(row_sim.masked_fill(~mask, 0.))
+        # Max and LogSumExp ignore -inf
+        return self.aggregate_function(row_sim.masked_fill(~mask, -np.inf))
+
+    def pair_cost(self, img_embed, cap_embed):
+        """
+        Bytes used per (image, caption) pair, per image and per caption
+        """
+        if isinstance(img_embed, RaggedEmbeddings):
+            itemsize = img_embed.data.element_size()
+            n_regions, latent_size = img_embed.max_length, img_embed.dim
+        else:
+            itemsize = img_embed.element_size()
+            n_regions, latent_size = img_embed.shape[1], img_embed.shape[2]
+        if isinstance(cap_embed, RaggedEmbeddings):
+            n_word = cap_embed.max_length
+        else:
+            n_word = cap_embed.shape[1]
+
+        # region-word scores, attention weights (normalized and
+        # smoothed) and the Gram products. Images and captions hold
+        # their embeddings and Gram matrices.
+        pair = 4 * n_regions * n_word
+        return (
+            itemsize * pair,
+            itemsize * n_regions * (latent_size + n_regions),
+            itemsize * n_word * (latent_size + n_word),
+        )
 
     def __repr__(self, ):
         return (
@@ -137,18 +396,53 @@ class StackedAttention(nn.Module):
             f'feature_norm: {self.feature_norm}, '
             f'lambda_lse: {self.lambda_lse}, '
             f'smooth: {self.smooth}, '
+            f'chunk_size: {self.chunk_size}, '
             f'kwargs: {self.kwargs})'
         )
 
 
 
-def attn_softmax(attn):
-    batch_size, sourceL, queryL = attn.shape
-    attn = attn.view(batch_size*sourceL, queryL)
-    attn = nn.Softmax(dim=-1)(attn)
-    # --> (batch, sourceL, queryL)
-    attn = attn.view(batch_size, sourceL, queryL)
-    return attn
+def _safe_cosine(w12, w1, w2_squared, eps=1e-8):
+    """
+    Cosine from the dot product, the norm of one side and the squared
+    norm of the other. Reduced-precision inputs are upcast to float32,
+    so that they do not underflow eps.
+    """
+    if w12.dtype in (torch.float16, torch.bfloat16):
+        w12, w1, w2_squared = w12.float(), w1.float(), w2_squared.float()
+    w2 = w2_squared.clamp(min=eps**2).sqrt()
+    return w12 / (w1 * w2).clamp(min=eps)
+
+
+def lengths_to_mask(lengths, max_length, device=None):
+    """
+    (n, max_length) boolean mask, True for the first lengths[i] positions
+    """
+    if torch.is_tensor(lengths):
+        lengths = lengths.to(device)
+    else:
+        lengths = torch.tensor(np.asarray(lengths), device=device)
+    positions = torch.arange(max_length, device=device)
+    return positions.unsqueeze(0) < lengths.long().unsqueeze(1)
+
+
+def mask_queries(attn, mask, value):
+    """
+    Fill the padded query positions of an attention map.
+    mask: broadcastable to attn, True for real positions
+        (e.g., (batch, 1, queryL) for (batch, sourceL, queryL) maps)
+    """
+    if mask is None:
+        return attn
+    return attn.masked_fill(~mask, value)
+
+
+def attn_softmax(attn, mask=None, dim=-1):
+    """
+    Softmax over the query dimension (the last one by default)
+    """
+    attn = mask_queries(attn, mask, -np.inf)
+    return F.softmax(attn, dim=dim)
 
 
 class Attention(nn.Module):
@@ -170,13 +464,28 @@ class Attention(nn.Module):
         #     attn = nn.LeakyReLU(0.1)(attn)
         #     attn = l1norm_d(attn, 2)
         elif feature_norm == "clipped":
-            self.normalize_attn = lambda x: nn.LeakyReLU(0.1)(x)
+            self.normalize_attn = lambda x, mask=None, dim=-1: mask_queries(
+                F.leaky_relu(x, 0.1), mask, 0.
+            )
         elif feature_norm == "no_norm":
-            self.normalize_attn = lambda x: x
+            self.normalize_attn = lambda x, mask=None, dim=-1: mask_queries(
+                x, mask, 0.
+            )
         else:
             raise ValueError("unknown first norm type:", feature_norm)
 
-    def forward(self, query, context, ):
+    def forward(self, query, context, query_mask=None, context_mask=None):
+        """
+        query: (batch, queryL, d)
+        context: (batch, sourceL, d)
+        query_mask, context_mask: (batch, queryL) and (batch, sourceL)
+            boolean masks of real (not padded) positions, e.g., words
+            of variable-length captions or regions of images
+
+        Padded queries get no weight in the feature normalization
+        (their attention is zero) and padded context positions get
+        no weight in the attention softmax.
+        """
         batch_size_q, queryL = query.size(0), query.size(1)
         batch_size, sourceL = context.size(0), context.size(1)
 
@@ -187,9 +496,13 @@ class Attention(nn.Module):
         # (batch, sourceL, d)(batch, d, queryL)
         # --> (batch, sourceL, queryL)
         attn = torch.bmm(context, queryT)
-        attn = self.normalize_attn(attn)
+        if query_mask is not None:
+            query_mask = query_mask.unsqueeze(1)
+        attn = self.normalize_attn(attn, query_mask)
         # --> (batch, queryL, sourceL)
         attn = torch.transpose(attn, 1, 2).contiguous()
+        if context_mask is not None:
+            attn = attn.masked_fill(~context_mask.unsqueeze(1), -np.inf)
         # --> (batch*queryL, sourceL)
         attn = attn.view(batch_size*queryL, sourceL)
         attn = nn.Softmax(dim=-1)(attn*self.smooth)
@@ -1,3 +1,5 @@
+from . import embedding_cache
 from . import evaluation
+from . import grad_cache
 from . import test
 from . import train
@@ -0,0 +1,170 @@
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from ..utils.logger import get_logger
+
+logger = get_logger()
+
+
+def snapshot_state(model):
+    """
+    CPU copy of the model weights, without (Distributed)DataParallel
+    prefixes, so it can be loaded in a plain LAVSE model
+    """
+    return {
+        (k[7:] if k.startswith('module.') else k): v.detach().to('cpu', copy=True)
+        for k, v in model.state_dict().items()
+    }
+
+
+def _loader_spec(loader):
+    # DataLoaders are rebuilt in the worker from their dataset
+    return dict(
+        dataset=loader.dataset,
+        batch_size=loader.batch_size,
+        collate_fn=loader.collate_fn,
+        num_workers=loader.num_workers,
+    )
+
+
+def _worker(
+    model_args, tokenizers, loader_specs,
+    eval_options, val_metric, device, jobs, results,
+):
+    from ..model.model import LAVSE
+    from .train import Trainer
+
+    model = LAVSE(**model_args, tokenizers=tokenizers)
+    model.set_device(device)
+    model = model.to(device)
+    model.master = False
+
+    trainer = Trainer(
+        model=model, device=device,
+        sysoutlog=lambda x: x, master=False,
+    )
+    trainer.val_metric = val_metric
+    trainer.setup_eval(**eval_options)
+
+    loaders = [
+        DataLoader(shuffle=False, pin_memory=True, **spec)
+        for spec in loader_specs
+    ]
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        iteration, state = job
+        try:
+            model.load_state_dict(state)
+            metrics, metric_value = trainer.evaluate_loaders(loaders)
+            results.put((iteration, metrics, metric_value, None))
+        except Exception:
+            results.put((iteration, None, None, traceback.format_exc()))
+
+
+class AsyncEvaluator:
+    """
+    Validation of model snapshots in a background process.
+
+    submit() copies the weights to the host and hands them to the
+    worker, which rebuilds the model from model_args and evaluates the
+    validation loaders with the Trainer evaluation options. Only one
+    snapshot is evaluated at a time: rounds submitted while the worker
+    is busy are skipped. poll() returns the finished rounds along with
+    the evaluated weights (e.g., to save the best checkpoint).
+    """
+
+    def __init__(
+        self, model_args, tokenizers, valid_loaders,
+        eval_options, val_metric='rsum', device='cuda',
+        start_method='spawn',
+    ):
+        # CUDA can not be re-initialized in forked processes
+        ctx = mp.get_context(start_method)
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = {}
+
+        self.process = ctx.Process(
+            target=_worker,
+            args=(
+                model_args, tokenizers,
+                [_loader_spec(x) for x in valid_loaders],
+                eval_options, val_metric, torch.device(device),
+                self.jobs, self.results,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        logger.info(f'Background validation worker started on {device}')
+
+    @property
+    def busy(self):
+        return len(self.pending) > 0
+
+    def submit(self, iteration, model):
+        """
+        Evaluate the current weights of `model` unless the worker
+        is still busy. Returns whether the snapshot was submitted.
+        """
+        self._check_alive()
+        if self.busy:
+            logger.info((
+                f'Skipping validation of iteration {iteration}, '
+                f'still evaluating iteration {list(self.pending)[0]}'
+            ))
+            return False
+
+        state = snapshot_state(model)
+        self.pending[iteration] = state
+        self.jobs.put((iteration, state))
+        return True
+
+    def poll(self, wait=False):
+        """
+        (iteration, metrics, metric_value, state) of every finished
+        round. wait blocks until every submitted round has finished.
+        """
+        finished = []
+        while self.pending:
+            try:
+                if wait:
+                    result = self.results.get(timeout=1.)
+                else:
+                    result = self.results.get_nowait()
+            except queue.Empty:
+                if not wait:
+                    break
+                self._check_alive()
+                continue
+
+            iteration, metrics, metric_value, error = result
+            state = self.pending.pop(iteration)
+            if error is not None:
+                raise RuntimeError(
+                    f'Background validation of iteration {iteration} '
+                    f'failed:\n{error}'
+                )
+            finished.append((iteration, metrics, metric_value, state))
+
+        return finished
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError(
+                'Background validation worker exited '
+                f'(exit code {self.process.exitcode})'
+            )
+
+    def close(self):
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
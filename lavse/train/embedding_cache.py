@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from ..utils.logger import get_logger
+
+logger = get_logger()
+
+
+def fingerprint_modules(*modules):
+    """
+    sha1 of the parameters and buffers of `modules`
+
+    Buffers are included, e.g., BatchNorm running statistics
+    also change the embeddings of a frozen encoder.
+    """
+    sha = hashlib.sha1()
+    for module in modules:
+        for name, tensor in module.state_dict().items():
+            tensor = tensor.detach().cpu()
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.float()
+            sha.update(name.encode())
+            sha.update(f'{tuple(tensor.shape)}{tensor.dtype}'.encode())
+            sha.update(tensor.contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def dataset_key(dataset):
+    """
+    Identifies the dataset split of a validation loader
+    """
+    data_path = getattr(dataset, 'data_path', '')
+    return f'{type(dataset).__name__}.{dataset}.{data_path}.{len(dataset)}'
+
+
+class EmbeddingCache:
+    """
+    Validation embeddings of unchanged encoders.
+
+    Entries are keyed by (kind, dataset split, dtype) and tagged with the
+    fingerprint of the encoder that produced them. An entry is only
+    returned when the encoder fingerprint still matches, so trainable
+    encoders simply miss. Only the latest entry of each key is kept in
+    memory. When cache_dir is given, entries are also saved there and
+    reloaded when they are not in memory (e.g., by another process).
+    """
+
+    def __init__(self, cache_dir=None, in_memory=True):
+        self.cache_dir = cache_dir
+        self.in_memory = in_memory
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key, fingerprint):
+        name = hashlib.sha1(f'{key}.{fingerprint}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.pth')
+
+    def get(self, key, fingerprint):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            return entry[1]
+
+        if self.cache_dir is not None:
+            path = self._path(key, fingerprint)
+            if os.path.exists(path):
+                # Entries hold numpy arrays and RaggedEmbeddings written
+                # by this cache, not only tensors
+                value = torch.load(path, weights_only=False)
+                if self.in_memory:
+                    self._entries[key] = (fingerprint, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, fingerprint, value):
+        if self.in_memory:
+            self._entries[key] = (fingerprint, value)
+        if self.cache_dir is not None:
+            torch.save(value, self._path(key, fingerprint))
+
+    def fetch(self, kind, dataset, modules, dtype, compute_fn):
+        """
+        Cached value of compute_fn() for the embeddings of `kind`
+        produced by `modules` on `dataset` stored in `dtype`
+        """
+        key = f'{kind}.{dataset_key(dataset)}.{np.dtype(dtype).name}'
+        fingerprint = fingerprint_modules(*modules)
+
+        value = self.get(key, fingerprint)
+        if value is not None:
+            logger.debug(f'Using cached {kind} embeddings of {dataset}')
+            return value
+
+        value = compute_fn()
+        self.put(key, fingerprint, value)
+        return value
+
+    def clear(self):
+        self._entries = {}
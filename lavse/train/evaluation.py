@@ -2,34 +2,69 @@ from timeit import default_timer as dt
 
 import numpy as np
 import torch
+import torch.distributed as dist
 
+from ..data import loaders
+from ..model.similarity.autotune import get_shard_sizes
+from ..model.similarity.measure import l2norm
+from ..model.similarity.similarity import lengths_to_mask
 from ..utils import layers
+from ..utils.ragged import RaggedEmbeddings, lengths_to_offsets
 from ..model.loss import cosine_sim
 
 from tqdm import tqdm
 
 
-@torch.no_grad()
-def predict_loader(model, data_loader, device,):
-
-    model.eval()
-
-    # np array to keep all the embeddings
-    img_embs = None
-    cap_embs = None
-    cap_lens = None
-
+def _get_pbar_fn(model, desc):
     pbar_fn = lambda x: x
     if model.master:
         pbar_fn = lambda x: tqdm(
             x, total=len(x),
-            desc='Pred  ',
+            desc=desc,
             leave=False,
         )
+    return pbar_fn
+
+
+@torch.no_grad()
+def predict_images(model, data_loader, dtype=np.float32):
+    """
+    Embed every image of an ImageView loader once
+    """
+    model.eval()
+
+    img_embs = None
+    pbar_fn = _get_pbar_fn(model, 'Images')
+
+    for batch in pbar_fn(data_loader):
+        ids = batch['index']
+        img_emb = model.embed_images(batch['image'])
+
+        if img_embs is None:
+            img_embs = np.zeros(
+                (len(data_loader.dataset),) + tuple(img_emb.shape[1:]),
+                dtype=dtype,
+            )
+        img_embs[ids] = img_emb.data.cpu().numpy()
+
+    return img_embs
+
+
+@torch.no_grad()
+def predict_captions(model, data_loader, dtype=np.float32):
+    """
+    Embed every caption of a CaptionView loader
 
-    # for i, (images, captions, lengths, ids) in enumerate(data_loader):
-    #     max_n_word = max(max_n_word, max(lengths))
-    max_n_word = 77
+    Returns a (n_captions, d) array for vector embeddings. Word-level
+    embeddings are returned as RaggedEmbeddings sized by the real
+    caption lengths (no padding). The loader must be sequential.
+    """
+    model.eval()
+
+    cap_embs = None
+    cap_lens = [0] * len(data_loader.dataset)
+    chunks = []
+    pbar_fn = _get_pbar_fn(model, 'Caps  ')
 
     for batch in pbar_fn(data_loader):
 
@@ -38,58 +73,155 @@ def predict_loader(model, data_loader, device,):
             (_, _), (_, lengths) = batch['caption']
         else:
             cap, lengths = batch['caption']
-        img_emb, cap_emb = model.forward_batch(batch)
-
-        if img_embs is None:
-            if len(img_emb.shape) == 3:
-                is_tensor = True
-                img_embs = np.zeros((len(data_loader.dataset), img_emb.size(1), img_emb.size(2)))
-                cap_embs = np.zeros((len(data_loader.dataset), max_n_word, cap_emb.size(2)))
-            else:
-                is_tensor = False
-                img_embs = np.zeros((len(data_loader.dataset), img_emb.size(1)))
-                cap_embs = np.zeros((len(data_loader.dataset), cap_emb.size(1)))
-            cap_lens = [0] * len(data_loader.dataset)
-        # cache embeddings
-        img_embs[ids] = img_emb.data.cpu().numpy()
-        if is_tensor:
-            cap_embs[ids,:max(lengths),:] = cap_emb.data.cpu().numpy()
-        else:
-            cap_embs[ids,] = cap_emb.data.cpu().numpy()
+        cap_emb = model.embed_captions(batch)
 
         for j, nid in enumerate(ids):
-            cap_lens[nid] = lengths[j]
-
-    # Remove image feature redundancy
-    if img_embs.shape[0] == cap_embs.shape[0]:
-        img_embs = img_embs[
-            np.arange(
-                start=0,
-                stop=img_embs.shape[0],
-                step=data_loader.dataset.captions_per_image,
-            ).astype(np.int),
-        ]
+            cap_lens[nid] = int(lengths[j])
+
+        if len(cap_emb.shape) == 3:
+            chunk = RaggedEmbeddings.from_padded(cap_emb.data, lengths)
+            chunks.append(chunk.numpy(dtype))
+            continue
+
+        if cap_embs is None:
+            cap_embs = np.zeros(
+                (len(data_loader.dataset), cap_emb.size(1)),
+                dtype=dtype,
+            )
+        cap_embs[ids,] = cap_emb.data.cpu().numpy()
+
+    if chunks:
+        cap_embs = RaggedEmbeddings.concatenate(chunks)
+
+    return cap_embs, cap_lens
+
+
+@torch.no_grad()
+def predict_loader(
+    model, data_loader, device,
+    img_batch_size=None, cap_batch_size=None,
+    dtype=np.float32, cache=None, cached=('images', 'captions'),
+):
+    """
+    Embed the images and captions of a validation loader.
+
+    Images are embedded once each (by image id) and captions in a
+    separate pass, so image encoders never see duplicated images.
+    Both passes default to the batch size of `data_loader`.
+    Embeddings are stored in `dtype` (e.g., np.float16 halves the
+    host memory).
+
+    cache: EmbeddingCache. The `cached` passes ('images' and/or
+    'captions') are skipped while their encoder is unchanged.
+    """
+    model.eval()
+    dtype = np.dtype(dtype)
+
+    img_loader = loaders.get_image_loader(
+        data_loader, batch_size=img_batch_size,
+    )
+    cap_loader = loaders.get_caption_loader(
+        data_loader, batch_size=cap_batch_size,
+    )
+
+    predict_images_fn = lambda: predict_images(model, img_loader, dtype=dtype)
+    predict_captions_fn = lambda: predict_captions(model, cap_loader, dtype=dtype)
+
+    if cache is not None and 'images' in cached:
+        img_embs = cache.fetch(
+            'images', data_loader.dataset,
+            modules=(model.img_enc, model.img_pool),
+            dtype=dtype, compute_fn=predict_images_fn,
+        )
+    else:
+        img_embs = predict_images_fn()
+
+    if cache is not None and 'captions' in cached:
+        cap_embs, cap_lens = cache.fetch(
+            'captions', data_loader.dataset,
+            modules=(model.txt_enc, model.txt_pool),
+            dtype=dtype, compute_fn=predict_captions_fn,
+        )
+    else:
+        cap_embs, cap_lens = predict_captions_fn()
 
     return img_embs, cap_embs, cap_lens
 
 
+def synchronize(device):
+    """
+    Wait for pending kernels so timings cover the actual work
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def get_torch_dtype(dtype):
+    """
+    torch dtype from its name (e.g., 'bfloat16'), float32 when None
+    """
+    if dtype is None:
+        return torch.float32
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    return getattr(torch, str(dtype))
+
+
+def to_device(embeddings, device, dtype=torch.float32):
+    """
+    Move numpy/ragged embeddings to `device` as `dtype` tensors
+    """
+    dtype = get_torch_dtype(dtype)
+    if isinstance(embeddings, RaggedEmbeddings):
+        return embeddings.to(device, dtype=dtype)
+    if not torch.is_tensor(embeddings):
+        embeddings = torch.from_numpy(np.ascontiguousarray(embeddings))
+    return embeddings.to(device=device, dtype=dtype)
+
+
 @torch.no_grad()
 def evaluate(
     model, img_emb, txt_emb, lengths,
-    device, shared_size=128, return_sims=False
+    device, shared_size=128, return_sims=False,
+    rank_block_size=1024, sim_on_device=False,
+    memory_budget=None, folds=None, rerank_k=None,
+    sim_dtype=None, precision_guard=1000, num_workers=1,
 ):
+    """
+    shared_size: shard size or (image, caption) shard sizes
+    memory_budget: bytes per similarity block, shard sizes are then
+        autotuned from the similarity cost
+    sim_on_device: keep the similarity matrix in `device` (ranking
+        runs there as well). Otherwise it is streamed back to the host,
+        overlapping the copies with the similarity computation.
+    folds: number of equal image folds or list of (start, end) image
+        ranges (e.g., 5 for COCO 5x1k). Fold metrics are ranked on the
+        diagonal blocks of the same similarity matrix.
+    rerank_k: shortlist sizes of the two-stage retrieval (see
+        evaluate_rerank), reported next to the exhaustive metrics.
+    sim_dtype: precision of the similarity computation (e.g.,
+        'float16' on GPUs or 'bfloat16' on CPUs, default: float32)
+    precision_guard: with a reduced sim_dtype, number of sampled
+        queries rescored in float32 to report the recall delta
+        (precision_*_delta, see precision_guard_metrics). 0 disables it.
+    num_workers: threads scoring similarity blocks on CPU
+    """
     model.eval()
     _metrics_ = ('r1', 'r5', 'r10', 'medr', 'meanr')
 
     begin_pred = dt()
 
-    img_emb = torch.tensor(img_emb).to(device)
-    txt_emb = torch.tensor(txt_emb).to(device)
+    host_img_emb, host_txt_emb = img_emb, txt_emb
+    img_emb = to_device(img_emb, device, dtype=sim_dtype)
+    txt_emb = to_device(txt_emb, device, dtype=sim_dtype)
 
     end_pred = dt()
     sims = model.compute_pairwise_similarity(
         model.similarity, img_emb, txt_emb, lengths,
-        shared_size=shared_size
+        shared_size=shared_size, memory_budget=memory_budget,
+        output_device=device if sim_on_device else 'cpu',
+        num_workers=num_workers,
     )
     print(sims.min(), sims.max(), sims.mean())
         # sims = model.get_sim_matrix(
@@ -97,15 +229,15 @@ def evaluate(
         #     lens=lengths,
         # )
     div = sims.shape[1] / sims.shape[0]
-    samp_sim = sims[:,np.arange(0, sims.shape[1], div).astype(np.int)]
+    samp_sim = sims[:,np.arange(0, sims.shape[1], div).astype(np.int64)]
 
     val_loss = model.multimodal_criterion(samp_sim)
-    sims = layers.tensor_to_numpy(sims)
 
+    synchronize(device)
     end_sim = dt()
 
-    i2t_metrics = i2t(sims)
-    t2i_metrics = t2i(sims)
+    i2t_metrics = i2t(sims, block_size=rank_block_size)
+    t2i_metrics = t2i(sims, block_size=rank_block_size)
 
     rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
 
@@ -121,17 +253,1006 @@ def evaluate(
     metrics.update(t2i_metrics)
     metrics['rsum'] = rsum
 
+    if folds:
+        fold_ranks = []
+        for im_start, im_end, cap_start, cap_end in get_fold_ranges(
+            sims.shape[0], sims.shape[1], folds
+        ):
+            block = sims[im_start:im_end, cap_start:cap_end]
+            fold_ranks.append((
+                i2t_ranks(block, block_size=rank_block_size)[0],
+                t2i_ranks(block, block_size=rank_block_size)[0],
+            ))
+        metrics.update(fold_metrics(fold_ranks))
+
+    if rerank_k:
+        metrics.update(rerank_metrics(
+            model, img_emb, txt_emb, lengths, rerank_k,
+        ))
+
+    reduced = get_torch_dtype(sim_dtype) != torch.float32
+    if reduced and precision_guard:
+        metrics.update(precision_guard_metrics(
+            model, host_img_emb, host_txt_emb, lengths, sims, device,
+            n_samples=precision_guard, shared_size=shared_size,
+        ))
+
     if return_sims:
-        return metrics, sims
+        return metrics, layers.tensor_to_numpy(sims)
+
+    return metrics
+
+
+@torch.no_grad()
+def evaluate_streaming(
+    model, img_emb, txt_emb, lengths,
+    device, shared_size=128, topk=10, return_topk=False,
+    memory_budget=None, folds=None, sim_dtype=None,
+):
+    """
+    Same recall/medr/meanr metrics as evaluate(), computed shard by
+    shard. Only ground-truth ranks and a running top-k per query are
+    kept, so memory is bounded by the shard size instead of by the
+    (n_images, n_captions) similarity matrix.
+
+    The validation loss is not reported, as it requires the full matrix.
+    Fold ranks (see evaluate) are counted from the same blocks.
+    """
+    model.eval()
+    _metrics_ = ('r1', 'r5', 'r10', 'medr', 'meanr')
+
+    begin_pred = dt()
+
+    img_emb = to_device(img_emb, device, dtype=sim_dtype)
+    txt_emb = to_device(txt_emb, device, dtype=sim_dtype)
+
+    end_pred = dt()
+
+    accumulator = RankAccumulator(
+        n_images=len(img_emb), n_captions=len(txt_emb),
+        device=device, topk=topk, folds=folds,
+    )
+    shard_sizes = get_shard_sizes(
+        model.similarity, img_emb, txt_emb,
+        shared_size=shared_size, memory_budget=memory_budget,
+    )
+    compute_ground_truth(
+        model.similarity, img_emb, txt_emb, lengths,
+        accumulator, shared_size=shard_sizes,
+    )
+    for im_start, cap_start, sim in model.iter_pairwise_similarity(
+        model.similarity, img_emb, txt_emb, lengths,
+        shared_size=shard_sizes,
+    ):
+        accumulator.update(sim, im_start, cap_start)
+
+    synchronize(device)
+    end_sim = dt()
+
+    i2t_metrics = ranks_to_metrics(accumulator.i2t_ranks)
+    t2i_metrics = ranks_to_metrics(accumulator.t2i_ranks)
+
+    rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
+
+    i2t_metrics = {f'i2t_{k}': v for k, v in zip(_metrics_, i2t_metrics)}
+    t2i_metrics = {f't2i_{k}': v for k, v in zip(_metrics_, t2i_metrics)}
+
+    metrics = {
+        'pred_time': end_pred-begin_pred,
+        'sim_time': end_sim-end_pred,
+    }
+    metrics.update(i2t_metrics)
+    metrics.update(t2i_metrics)
+    metrics['rsum'] = rsum
+    metrics.update(fold_metrics(accumulator.fold_ranks()))
+
+    if return_topk:
+        return metrics, accumulator.get_topk()
+
+    return metrics
+
+
+@torch.no_grad()
+def evaluate_rerank(
+    model, img_emb, txt_emb, lengths, device,
+    rerank_k=(10, 50, 100), batch_size=4096,
+):
+    """
+    Two-stage retrieval: every query shortlists its top-K candidates
+    by cosine similarity of the pooled embeddings, then only the
+    shortlist is scored by model.similarity (e.g., StackedAttention).
+
+    Metrics are reported for each K in rerank_k (rerank{K}_*). The
+    unprefixed metrics are the ones of the largest K.
+    """
+    model.eval()
+    if isinstance(rerank_k, int):
+        rerank_k = [rerank_k]
+
+    begin_pred = dt()
+
+    img_emb = to_device(img_emb, device)
+    txt_emb = to_device(txt_emb, device)
+
+    end_pred = dt()
+
+    metrics = {'pred_time': end_pred-begin_pred}
+    rerank = rerank_metrics(
+        model, img_emb, txt_emb, lengths, rerank_k,
+        batch_size=batch_size,
+    )
+    prefix = f'rerank{max(rerank_k)}_'
+    metrics.update({
+        k[len(prefix):]: v for k, v in rerank.items()
+        if k.startswith(prefix)
+    })
+    metrics.update(rerank)
+
+    return metrics
+
+
+def pool_embeddings(embeddings, lengths=None):
+    """
+    (n, d) mean of the real positions of (n, L, d) or ragged
+    embeddings. Vector embeddings are returned as they are.
+    """
+    if isinstance(embeddings, RaggedEmbeddings):
+        data = embeddings.data
+        lengths = embeddings.lengths_array
+        segments = np.repeat(np.arange(len(embeddings)), lengths)
+        segments = torch.from_numpy(segments).to(data.device)
+        pooled = data.new_zeros(len(embeddings), embeddings.dim)
+        pooled.index_add_(0, segments, data)
+        counts = torch.from_numpy(lengths).to(data.device).clamp(min=1)
+        return pooled / counts.unsqueeze(1).type_as(pooled)
+
+    if embeddings.dim() == 2:
+        return embeddings
+    if lengths is None:
+        return embeddings.mean(1)
+
+    mask = lengths_to_mask(lengths, embeddings.shape[1], embeddings.device)
+    mask = mask.unsqueeze(2).type_as(embeddings)
+    return (embeddings * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+
+@torch.no_grad()
+def pooled_shortlist(queries, candidates, k, gt_fn=None, block_size=1024):
+    """
+    Top-k candidates of every query by cosine similarity of pooled
+    embeddings, sorted by decreasing similarity
+
+    gt_fn(rows): (block, n_gt) ground-truth candidates of the query
+        rows. When given, the rank of the best ground truth among every
+        candidate is also returned (otherwise None).
+
+    Returns (index, ranks)
+    """
+    queries = l2norm(queries, dim=1)
+    candidates = l2norm(candidates, dim=1)
+    n, device = len(queries), queries.device
+    k = min(k, len(candidates))
+
+    index = torch.zeros(n, k, dtype=torch.long, device=device)
+    ranks = None
+    if gt_fn is not None:
+        ranks = torch.zeros(n, dtype=torch.long, device=device)
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        sim = cosine_sim(queries[start:end], candidates)
+        index[start:end] = sim.topk(k, dim=1)[1]
+        if gt_fn is not None:
+            rows = torch.arange(start, end, device=device)
+            gt_scores = sim.gather(1, gt_fn(rows)).max(1, keepdim=True)[0]
+            ranks[start:end] = (sim > gt_scores).sum(1)
+
+    return index, ranks
+
+
+def _take(embeddings, index):
+    if isinstance(embeddings, RaggedEmbeddings):
+        return embeddings.take(index)
+    if torch.is_tensor(embeddings):
+        return embeddings[torch.from_numpy(index).to(embeddings.device)]
+    return embeddings[index]
+
+
+@torch.no_grad()
+def precision_guard_metrics(
+    model, img_emb, txt_emb, lengths, sims, device,
+    n_samples=1000, shared_size=128, seed=0,
+):
+    """
+    Recall delta of a similarity matrix computed in reduced precision
+
+    n_samples images (i2t) and captions (t2i) are drawn and their rows
+    (columns) are rescored in float32 against every candidate. Ranks of
+    these queries are computed from both and the differences
+    (reduced - float32) are reported as precision_*_delta, along with
+    the largest absolute similarity error.
+
+    img_emb, txt_emb: host (or device) embeddings as given to evaluate
+    sims: (n_images, n_captions) reduced-precision similarities
+    """
+    _metrics_ = ('r1', 'r5', 'r10')
+    n_images, n_captions = len(img_emb), len(txt_emb)
+    captions_per_image = n_captions // n_images
+    lengths = np.asarray(lengths)
+    rng = np.random.RandomState(seed)
+
+    begin = dt()
+
+    # i2t: sampled images against every caption
+    rows = np.sort(rng.choice(n_images, min(n_samples, n_images), replace=False))
+    i2t_sims = model.compute_pairwise_similarity(
+        model.similarity,
+        to_device(_take(img_emb, rows), device),
+        to_device(txt_emb, device), lengths,
+        shared_size=shared_size,
+    )
+    gt_cols = (
+        rows[:, None] * captions_per_image + np.arange(captions_per_image)
+    )
+
+    # t2i: every image against sampled captions
+    cols = np.sort(rng.choice(n_captions, min(n_samples, n_captions), replace=False))
+    t2i_sims = model.compute_pairwise_similarity(
+        model.similarity,
+        to_device(img_emb, device),
+        to_device(_take(txt_emb, cols), device), lengths[cols].tolist(),
+        shared_size=shared_size,
+    ).t()
+    gt_rows = (cols // captions_per_image)[:, None]
+
+    sims = _to_tensor(sims)
+    reduced_i2t = sims[torch.from_numpy(rows).to(sims.device)].float().cpu()
+    reduced_t2i = sims[:, torch.from_numpy(cols).to(sims.device)].t().float().cpu()
+    i2t_sims, t2i_sims = i2t_sims.float().cpu(), t2i_sims.float().cpu()
+
+    metrics = {}
+    for task, fp32, reduced, gt in (
+        ('i2t', i2t_sims, reduced_i2t, gt_cols),
+        ('t2i', t2i_sims, reduced_t2i, gt_rows),
+    ):
+        gt = torch.from_numpy(gt)
+        fp32_metrics = ranks_to_metrics(_query_ranks(fp32, gt))
+        reduced_metrics = ranks_to_metrics(_query_ranks(reduced, gt))
+        for name, a, b in zip(_metrics_, reduced_metrics, fp32_metrics):
+            metrics[f'precision_{task}_{name}_delta'] = a - b
+
+    metrics['precision_rsum_delta'] = sum(
+        v for k, v in metrics.items() if k.endswith('_delta')
+    )
+    metrics['precision_max_abs_err'] = max(
+        (reduced_i2t - i2t_sims).abs().max().item(),
+        (reduced_t2i - t2i_sims).abs().max().item(),
+    )
+    metrics['precision_guard_time'] = dt() - begin
+    return metrics
+
+
+def _query_ranks(scores, gt_index):
+    """
+    scores: (n_queries, n_candidates)
+    gt_index: (n_queries, n_gt) ground-truth candidates of each query
+    """
+    gt_scores = scores.gather(1, gt_index).max(1, keepdim=True)[0]
+    return (scores > gt_scores).sum(1)
+
+
+@torch.no_grad()
+def score_candidates(
+    similarity, img_emb, txt_emb, lengths,
+    img_index, cap_index, batch_size=4096,
+):
+    """
+    Similarity of the pairs (img_emb[img_index[i]], txt_emb[cap_index[i]])
+    computed by similarity.score_pairs in batches of pairs
+    """
+    img_index = layers.tensor_to_numpy(img_index).astype(np.int64)
+    cap_index = layers.tensor_to_numpy(cap_index).astype(np.int64)
+    lengths = np.asarray(lengths)
+
+    scores = []
+    for start in range(0, len(img_index), batch_size):
+        img_batch = img_index[start:start+batch_size]
+        cap_batch = cap_index[start:start+batch_size]
+        scores.append(similarity.score_pairs(
+            _take(img_emb, img_batch),
+            _take(txt_emb, cap_batch),
+            lengths[cap_batch].tolist(),
+        ))
+    return torch.cat(scores)
+
+
+def _rerank_ranks(scores, gt_mask, pooled_ranks, k):
+    """
+    Ranks after rescoring the first k candidates. When no ground
+    truth is shortlisted its pooled rank (at least k) is kept.
+    """
+    scores, gt_mask = scores[:, :k], gt_mask[:, :k]
+    best_gt = scores.masked_fill(~gt_mask, -np.inf).max(1, keepdim=True)[0]
+    ranks = (scores > best_gt).sum(1)
+    return torch.where(gt_mask.any(1), ranks, pooled_ranks.clamp(min=k))
+
+
+@torch.no_grad()
+def rerank_metrics(
+    model, img_emb, txt_emb, lengths, rerank_k, batch_size=4096,
+):
+    """
+    Metrics of the two-stage retrieval for every shortlist size in
+    rerank_k. The largest shortlist is scored once, smaller ones use
+    its first candidates.
+    """
+    _metrics_ = ('r1', 'r5', 'r10', 'medr', 'meanr')
+    if isinstance(rerank_k, int):
+        rerank_k = [rerank_k]
+    rerank_k = sorted(rerank_k)
+
+    n_images, n_captions = len(img_emb), len(txt_emb)
+    captions_per_image = n_captions // n_images
+    device = img_emb.device
+
+    begin = dt()
+
+    img_pooled = pool_embeddings(img_emb)
+    cap_pooled = pool_embeddings(txt_emb, lengths)
+    offsets = torch.arange(captions_per_image, device=device)
+
+    i2t_index, i2t_pooled = pooled_shortlist(
+        img_pooled, cap_pooled, rerank_k[-1],
+        gt_fn=lambda rows: rows.unsqueeze(1) * captions_per_image + offsets,
+    )
+    t2i_index, t2i_pooled = pooled_shortlist(
+        cap_pooled, img_pooled, rerank_k[-1],
+        gt_fn=lambda rows: (rows // captions_per_image).unsqueeze(1),
+    )
+    synchronize(device)
+    end_prefilter = dt()
+
+    i2t_k, t2i_k = i2t_index.shape[1], t2i_index.shape[1]
+    image_rows = torch.arange(n_images, device=device)
+    caption_rows = torch.arange(n_captions, device=device)
+
+    i2t_scores = score_candidates(
+        model.similarity, img_emb, txt_emb, lengths,
+        img_index=image_rows.repeat_interleave(i2t_k),
+        cap_index=i2t_index.view(-1), batch_size=batch_size,
+    ).view(n_images, i2t_k).float()
+    t2i_scores = score_candidates(
+        model.similarity, img_emb, txt_emb, lengths,
+        img_index=t2i_index.view(-1),
+        cap_index=caption_rows.repeat_interleave(t2i_k),
+        batch_size=batch_size,
+    ).view(n_captions, t2i_k).float()
+
+    i2t_gt = (i2t_index // captions_per_image) == image_rows.unsqueeze(1)
+    t2i_gt = t2i_index == (caption_rows // captions_per_image).unsqueeze(1)
+
+    synchronize(device)
+    end_rerank = dt()
+
+    metrics = {
+        'prefilter_time': end_prefilter - begin,
+        'rerank_time': end_rerank - end_prefilter,
+    }
+    for k in rerank_k:
+        i2t_metrics = ranks_to_metrics(
+            _rerank_ranks(i2t_scores, i2t_gt, i2t_pooled, min(k, i2t_k))
+        )
+        t2i_metrics = ranks_to_metrics(
+            _rerank_ranks(t2i_scores, t2i_gt, t2i_pooled, min(k, t2i_k))
+        )
+        rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
+
+        metrics.update({
+            f'rerank{k}_i2t_{name}': v
+            for name, v in zip(_metrics_, i2t_metrics)
+        })
+        metrics.update({
+            f'rerank{k}_t2i_{name}': v
+            for name, v in zip(_metrics_, t2i_metrics)
+        })
+        metrics[f'rerank{k}_rsum'] = rsum
 
     return metrics
 
 
-def i2t(sims,):
+@torch.no_grad()
+def retrieve_images(
+    similarity, img_emb, cap_emb, lengths, rerank_k,
+    img_pooled=None, batch_size=4096,
+):
+    """
+    Images of every caption query ranked by the two-stage retrieval
+
+    img_pooled: pooled image embeddings, computed when not given
+    Returns (index, scores) of shape (n_captions, rerank_k), sorted
+    by decreasing similarity.
+    """
+    if img_pooled is None:
+        img_pooled = pool_embeddings(img_emb)
+    cap_pooled = pool_embeddings(cap_emb, lengths)
+
+    index, _ = pooled_shortlist(cap_pooled, img_pooled, rerank_k)
+    n_captions, k = index.shape
+    caption_rows = torch.arange(n_captions, device=index.device)
+
+    scores = score_candidates(
+        similarity, img_emb, cap_emb, lengths,
+        img_index=index.view(-1),
+        cap_index=caption_rows.repeat_interleave(k),
+        batch_size=batch_size,
+    ).view(n_captions, k)
+
+    scores, order = scores.sort(dim=1, descending=True)
+    return index.gather(1, order), scores
+
+
+@torch.no_grad()
+def compute_ground_truth(
+    similarity, img_emb, txt_emb, lengths,
+    accumulator, shared_size=128, img_offset=0,
+):
+    """
+    Score every image against its own captions only
+
+    img_emb may hold a contiguous slice of the images starting at
+    img_offset, while txt_emb always holds every caption.
+    """
+    n_images, n_captions = len(img_emb), len(txt_emb)
+    captions_per_image = accumulator.captions_per_image
+    im_size, cap_size = get_shard_sizes(
+        similarity, img_emb, txt_emb, shared_size=shared_size,
+    )
+
+    sim_kwargs = {}
+    if hasattr(similarity, 'normalize_inputs'):
+        img_emb, txt_emb = similarity.normalize_inputs(img_emb, txt_emb)
+        sim_kwargs['normalized'] = True
+
+    for im_start in range(0, n_images, im_size):
+        im_end = min(im_start + im_size, n_images)
+        im = img_emb[im_start:im_end]
+        if hasattr(similarity, 'prepare_images'):
+            im = similarity.prepare_images(im)
+        first_cap = (img_offset + im_start) * captions_per_image
+        last_cap = min((img_offset + im_end) * captions_per_image, n_captions)
+        for cap_start in range(first_cap, last_cap, cap_size):
+            cap_end = min(cap_start + cap_size, last_cap)
+            sim = similarity(
+                im, txt_emb[cap_start:cap_end], lengths[cap_start:cap_end],
+                **sim_kwargs
+            )
+            accumulator.set_ground_truth(
+                sim, img_offset + im_start, cap_start
+            )
+
+
+def get_rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def _split_range(n, rank, world_size):
+    """
+    Contiguous [start, end) slice of n items owned by rank. Slice
+    sizes differ by one at most, a slice is empty only when n is
+    smaller than world_size.
+    """
+    return n * rank // world_size, n * (rank + 1) // world_size
+
+
+def _comm_device(device):
+    # NCCL only exchanges CUDA tensors, gloo works with host tensors
+    if dist.get_backend() == 'nccl':
+        return torch.device(device)
+    return torch.device('cpu')
+
+
+def all_gather_rows(tensor, comm_device):
+    """
+    Concatenate (along dim 0) tensors with a different number
+    of rows in every rank, in rank order
+    """
+    world_size = dist.get_world_size()
+    device = tensor.device
+    tensor = tensor.to(comm_device)
+
+    size = torch.tensor([tensor.shape[0]], dtype=torch.long, device=comm_device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(x.item()) for x in sizes]
+
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+
+    return torch.cat([x[:n] for x, n in zip(gathered, sizes)], 0).to(device)
+
+
+def all_gather_captions(cap_embs, comm_device):
+    if isinstance(cap_embs, RaggedEmbeddings):
+        lengths = torch.from_numpy(cap_embs.lengths_array)
+        lengths = all_gather_rows(lengths, comm_device)
+        data = all_gather_rows(cap_embs.data, comm_device)
+        return RaggedEmbeddings(data, lengths_to_offsets(lengths.numpy()))
+    return all_gather_rows(cap_embs, comm_device)
+
+
+@torch.no_grad()
+def evaluate_distributed(
+    model, data_loader, device,
+    img_batch_size=None, cap_batch_size=None,
+    dtype=np.float32, shared_size=128, memory_budget=None,
+    folds=None,
+):
+    """
+    Evaluate one loader split among the processes of the default
+    process group (works with nccl and gloo backends).
+
+    Every rank embeds a slice of the images and of the captions. The
+    caption embeddings are all-gathered, then each rank scores its
+    image slice against every caption. Ranks only exchange the
+    ground-truth scores and the rank counts (O(n_images + n_captions)),
+    never the similarity matrix. Every rank ends up with the metrics,
+    rank 0 is the one expected to report them.
+
+    Ranks without images (more ranks than images) only take part in
+    the collective calls.
+    """
+    model.eval()
+    _metrics_ = ('r1', 'r5', 'r10', 'medr', 'meanr')
+
+    rank, world_size = get_rank_and_world_size()
+    comm_device = _comm_device(device)
+
+    dataset = data_loader.dataset
+    captions_per_image = dataset.captions_per_image
+    n_captions = len(dataset)
+    n_images = (n_captions - 1) // captions_per_image + 1
+
+    if n_captions < world_size:
+        raise ValueError(
+            f'Can not split {n_captions} captions among {world_size} ranks'
+        )
+
+    img_start, img_end = _split_range(n_images, rank, world_size)
+    cap_start, cap_end = _split_range(n_captions, rank, world_size)
+    has_images = img_end > img_start
+
+    begin_pred = dt()
+
+    img_loader = loaders.get_image_loader(
+        data_loader, batch_size=img_batch_size,
+        start=img_start, end=img_end,
+    )
+    cap_loader = loaders.get_caption_loader(
+        data_loader, batch_size=cap_batch_size,
+        start=cap_start, end=cap_end,
+    )
+    img_emb = None
+    if has_images:
+        img_emb = predict_images(model, img_loader, dtype=np.dtype(dtype))
+        img_emb = to_device(img_emb, device)
+    txt_emb, lengths = predict_captions(
+        model, cap_loader, dtype=np.dtype(dtype)
+    )
+
+    txt_emb = all_gather_captions(to_device(txt_emb, device), comm_device)
+    lengths = all_gather_rows(
+        torch.tensor(lengths, dtype=torch.long), comm_device
+    ).tolist()
+
+    end_pred = dt()
+
+    accumulator = RankAccumulator(
+        n_images=n_images, n_captions=n_captions,
+        captions_per_image=captions_per_image,
+        device=device, topk=0, folds=folds,
+    )
+    if has_images:
+        shard_sizes = get_shard_sizes(
+            model.similarity, img_emb, txt_emb,
+            shared_size=shared_size, memory_budget=memory_budget,
+        )
+        compute_ground_truth(
+            model.similarity, img_emb, txt_emb, lengths,
+            accumulator, shared_size=shard_sizes, img_offset=img_start,
+        )
+    accumulator.all_reduce_ground_truth(comm_device)
+
+    if has_images:
+        for im_start, txt_start, sim in model.iter_pairwise_similarity(
+            model.similarity, img_emb, txt_emb, lengths,
+            shared_size=shard_sizes,
+        ):
+            accumulator.update(sim, img_start + im_start, txt_start)
+
+    accumulator.all_reduce_counts(comm_device)
+
+    synchronize(device)
+    end_sim = dt()
+
+    i2t_metrics = ranks_to_metrics(accumulator.i2t_ranks)
+    t2i_metrics = ranks_to_metrics(accumulator.t2i_ranks)
+
+    rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
+
+    i2t_metrics = {f'i2t_{k}': v for k, v in zip(_metrics_, i2t_metrics)}
+    t2i_metrics = {f't2i_{k}': v for k, v in zip(_metrics_, t2i_metrics)}
+
+    metrics = {
+        'pred_time': end_pred-begin_pred,
+        'sim_time': end_sim-end_pred,
+    }
+    metrics.update(i2t_metrics)
+    metrics.update(t2i_metrics)
+    metrics['rsum'] = rsum
+    metrics.update(fold_metrics(accumulator.fold_ranks()))
+
+    return metrics
+
+
+def get_fold_ranges(n_images, n_captions, folds):
+    """
+    (im_start, im_end, cap_start, cap_end) of every fold
+
+    folds: number of equal image folds, which must divide n_images,
+        or list of (start, end) image ranges (images outside every
+        range are ignored). Captions follow the images they describe.
+    """
+    captions_per_image = n_captions // n_images
+    if isinstance(folds, int):
+        if n_images % folds:
+            raise ValueError(
+                f'{folds} folds do not split {n_images} images equally, '
+                'pass explicit (start, end) image ranges instead'
+            )
+        fold_size = n_images // folds
+        folds = [
+            (i * fold_size, (i + 1) * fold_size)
+            for i in range(folds)
+        ]
+
+    ranges = []
+    for im_start, im_end in folds:
+        assert 0 <= im_start < im_end <= n_images, (
+            f'Invalid fold ({im_start}, {im_end}) for {n_images} images'
+        )
+        ranges.append((
+            im_start, im_end,
+            im_start * captions_per_image, im_end * captions_per_image,
+        ))
+    return ranges
+
+
+def fold_metrics(fold_ranks):
+    """
+    Per-fold metrics (fold{i}_*) and their average (folds_*)
+    from a list of (i2t_ranks, t2i_ranks), one per fold
+    """
+    _metrics_ = ('r1', 'r5', 'r10', 'medr', 'meanr')
+    if not fold_ranks:
+        return {}
+
+    keys = (
+        [f'i2t_{k}' for k in _metrics_] +
+        [f't2i_{k}' for k in _metrics_] + ['rsum']
+    )
+
+    metrics = {}
+    all_folds = []
+    for i, (i2t_fold, t2i_fold) in enumerate(fold_ranks):
+        i2t_metrics = ranks_to_metrics(i2t_fold)
+        t2i_metrics = ranks_to_metrics(t2i_fold)
+        rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
+        values = list(i2t_metrics) + list(t2i_metrics) + [rsum]
+        all_folds.append(values)
+        metrics.update({f'fold{i}_{k}': v for k, v in zip(keys, values)})
+
+    mean = np.mean(all_folds, 0)
+    metrics.update({f'folds_{k}': v for k, v in zip(keys, mean)})
+    return metrics
+
+
+class RankAccumulator:
+    """
+    Ground-truth ranks and running top-k computed from blocks of the
+    similarity matrix, so the full matrix is never materialized.
+
+    Ground-truth scores must be set (set_ground_truth) before the
+    blocks are accumulated (update). Ranks follow i2t_ranks/t2i_ranks:
+    the number of candidates scored strictly above the ground truth.
+    Ground-truth cells are never counted: they may come from a pass
+    sharded differently, whose scores can differ by rounding.
+
+    With folds (see get_fold_ranges), candidates scored above the
+    ground truth are also counted within each fold.
+    """
+
+    def __init__(
+        self, n_images, n_captions, device,
+        captions_per_image=None, topk=10, folds=None,
+    ):
+        if captions_per_image is None:
+            captions_per_image = n_captions // n_images
+
+        self.n_images = n_images
+        self.n_captions = n_captions
+        self.captions_per_image = captions_per_image
+        self.device = device
+        self.topk = topk
+
+        self.i2t_gt = torch.full((n_images,), -np.inf, device=device)
+        self.t2i_gt = torch.full((n_captions,), -np.inf, device=device)
+        self.i2t_count = torch.zeros(n_images, dtype=torch.long, device=device)
+        self.t2i_count = torch.zeros(n_captions, dtype=torch.long, device=device)
+
+        self.folds = []
+        if folds:
+            self.folds = get_fold_ranges(
+                n_images, captions_per_image * n_images, folds
+            )
+            # Fold of every image, -1 when outside every fold
+            self.img_fold = torch.full(
+                (n_images,), -1, dtype=torch.long, device=device)
+            for i, (im_start, im_end, _, _) in enumerate(self.folds):
+                self.img_fold[im_start:im_end] = i
+            self.i2t_fold_count = torch.zeros_like(self.i2t_count)
+            self.t2i_fold_count = torch.zeros_like(self.t2i_count)
+
+        if topk > 0:
+            self.i2t_top_scores = torch.full(
+                (n_images, topk), -np.inf, device=device)
+            self.i2t_top_index = torch.zeros(
+                (n_images, topk), dtype=torch.long, device=device)
+            self.t2i_top_scores = torch.full(
+                (n_captions, topk), -np.inf, device=device)
+            self.t2i_top_index = torch.zeros(
+                (n_captions, topk), dtype=torch.long, device=device)
+
+    def _gt_mask(self, sim, im_start, cap_start):
+        rows = torch.arange(im_start, im_start + sim.shape[0], device=sim.device)
+        cols = torch.arange(cap_start, cap_start + sim.shape[1], device=sim.device)
+        return (cols.unsqueeze(0) // self.captions_per_image) == rows.unsqueeze(1)
+
+    def set_ground_truth(self, sim, im_start, cap_start):
+        """
+        sim: block of images [im_start, ...) x captions [cap_start, ...)
+        """
+        sim = sim.float().to(self.device)
+        im_end = im_start + sim.shape[0]
+        cap_end = cap_start + sim.shape[1]
+
+        gt_mask = self._gt_mask(sim, im_start, cap_start)
+        gt_sim = sim.masked_fill(~gt_mask, -np.inf)
+
+        self.i2t_gt[im_start:im_end] = torch.max(
+            self.i2t_gt[im_start:im_end], gt_sim.max(1)[0]
+        )
+        self.t2i_gt[cap_start:cap_end] = torch.max(
+            self.t2i_gt[cap_start:cap_end], gt_sim.max(0)[0]
+        )
+
+    def update(self, sim, im_start, cap_start):
+        """
+        sim: block of images [im_start, ...) x captions [cap_start, ...)
+        """
+        sim = sim.float().to(self.device)
+        im_end = im_start + sim.shape[0]
+        cap_end = cap_start + sim.shape[1]
+
+        i2t_gt = self.i2t_gt[im_start:im_end].unsqueeze(1)
+        t2i_gt = self.t2i_gt[cap_start:cap_end].unsqueeze(0)
+        not_gt = ~self._gt_mask(sim, im_start, cap_start)
+        i2t_above = (sim > i2t_gt) & not_gt
+        t2i_above = (sim > t2i_gt) & not_gt
+        self.i2t_count[im_start:im_end] += i2t_above.sum(1)
+        self.t2i_count[cap_start:cap_end] += t2i_above.sum(0)
+
+        if self.folds:
+            cols = torch.arange(cap_start, cap_end, device=self.device)
+            cap_images = (cols // self.captions_per_image).clamp(max=self.n_images - 1)
+            row_fold = self.img_fold[im_start:im_end].unsqueeze(1)
+            col_fold = self.img_fold[cap_images].unsqueeze(0)
+            same_fold = (row_fold == col_fold) & (row_fold >= 0)
+            self.i2t_fold_count[im_start:im_end] += (i2t_above & same_fold).sum(1)
+            self.t2i_fold_count[cap_start:cap_end] += (t2i_above & same_fold).sum(0)
+
+        if self.topk > 0:
+            self._merge_topk(
+                self.i2t_top_scores, self.i2t_top_index,
+                sim, slice(im_start, im_end), cap_start,
+            )
+            self._merge_topk(
+                self.t2i_top_scores, self.t2i_top_index,
+                sim.t(), slice(cap_start, cap_end), im_start,
+            )
+
+    def _merge_topk(self, top_scores, top_index, sim, rows, offset):
+        k = min(self.topk, sim.shape[1])
+        scores, index = sim.topk(k, dim=1)
+        scores = torch.cat([top_scores[rows], scores], 1)
+        index = torch.cat([top_index[rows], index + offset], 1)
+        scores, pos = scores.topk(self.topk, dim=1)
+        top_scores[rows] = scores
+        top_index[rows] = index.gather(1, pos)
+
+    def _all_reduce(self, tensor, op, comm_device):
+        reduced = tensor.to(comm_device)
+        dist.all_reduce(reduced, op=op)
+        tensor.copy_(reduced)
+
+    def all_reduce_ground_truth(self, comm_device):
+        """
+        Share the ground-truth scores computed by each rank
+        """
+        self._all_reduce(self.i2t_gt, dist.ReduceOp.MAX, comm_device)
+        self._all_reduce(self.t2i_gt, dist.ReduceOp.MAX, comm_device)
+
+    def all_reduce_counts(self, comm_device):
+        """
+        Sum the rank counts of every image slice
+        """
+        self._all_reduce(self.i2t_count, dist.ReduceOp.SUM, comm_device)
+        self._all_reduce(self.t2i_count, dist.ReduceOp.SUM, comm_device)
+        if self.folds:
+            self._all_reduce(self.i2t_fold_count, dist.ReduceOp.SUM, comm_device)
+            self._all_reduce(self.t2i_fold_count, dist.ReduceOp.SUM, comm_device)
+
+    @property
+    def i2t_ranks(self):
+        return self.i2t_count
+
+    @property
+    def t2i_ranks(self):
+        return self.t2i_count
+
+    def fold_ranks(self):
+        """
+        (i2t_ranks, t2i_ranks) within each fold
+        """
+        return [
+            (
+                self.i2t_fold_count[im_start:im_end],
+                self.t2i_fold_count[cap_start:cap_end],
+            )
+            for im_start, im_end, cap_start, cap_end in self.folds
+        ]
+
+    def get_topk(self):
+        if self.topk <= 0:
+            return {}
+        return {
+            'i2t_topk': layers.tensor_to_numpy(self.i2t_top_index),
+            'i2t_topk_scores': layers.tensor_to_numpy(self.i2t_top_scores),
+            't2i_topk': layers.tensor_to_numpy(self.t2i_top_index),
+            't2i_topk_scores': layers.tensor_to_numpy(self.t2i_top_scores),
+        }
+
+
+def _to_tensor(sims):
+    if torch.is_tensor(sims):
+        return sims
+    return torch.from_numpy(np.asarray(sims))
+
+
+def ranks_to_metrics(ranks):
+    """
+        Recall@1, 5, 10, median and mean rank from 0-based ranks
+    """
+    if torch.is_tensor(ranks):
+        ranks = layers.tensor_to_numpy(ranks)
+    ranks = np.asarray(ranks, dtype=np.float64)
+
+    r1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
+    r5 = 100.0 * len(np.where(ranks < 5)[0]) / len(ranks)
+    r10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
+    medr = np.floor(np.median(ranks)) + 1
+    meanr = ranks.mean() + 1
+
+    return (r1, r5, r10, medr, meanr)
+
+
+@torch.no_grad()
+def i2t_ranks(sims, captions_per_image=None, block_size=1024):
+    """
+        Rank of the best ground-truth caption for every image.
+
+        The rank is the number of captions scored strictly above the
+        best ground-truth caption, so no row is ever sorted. Works on
+        row blocks of `sims` in the device they are stored.
+
+        Returns (ranks, top1) as LongTensors of size n_images.
+    """
+    sims = _to_tensor(sims)
+    npts, ncaps = sims.shape
+    if captions_per_image is None:
+        captions_per_image = ncaps // npts
+
+    device = sims.device
+    offsets = torch.arange(captions_per_image, device=device)
+
+    ranks = torch.zeros(npts, dtype=torch.long, device=device)
+    top1 = torch.zeros(npts, dtype=torch.long, device=device)
+    for start in range(0, npts, block_size):
+        end = min(start + block_size, npts)
+        block = sims[start:end]
+        rows = torch.arange(start, end, device=device)
+        # --> (block, captions_per_image)
+        gt_cols = rows.unsqueeze(1) * captions_per_image + offsets
+        gt_scores = block.gather(1, gt_cols).max(1, keepdim=True)[0]
+        ranks[start:end] = (block > gt_scores).sum(1)
+        top1[start:end] = block.argmax(1)
+
+    return ranks, top1
+
+
+@torch.no_grad()
+def t2i_ranks(sims, captions_per_image=None, block_size=1024):
+    """
+        Rank of the ground-truth image for every caption.
+
+        Captions are processed in column blocks of `sims`.
+
+        Returns (ranks, top1) as LongTensors of size n_captions.
+    """
+    sims = _to_tensor(sims)
+    npts, ncaps = sims.shape
+    if captions_per_image is None:
+        captions_per_image = ncaps // npts
+
+    device = sims.device
+    ranks = torch.zeros(ncaps, dtype=torch.long, device=device)
+    top1 = torch.zeros(ncaps, dtype=torch.long, device=device)
+    for start in range(0, ncaps, block_size):
+        end = min(start + block_size, ncaps)
+        # --> (n_images, block)
+        block = sims[:, start:end]
+        cols = torch.arange(start, end, device=device)
+        gt_rows = cols // captions_per_image
+        gt_scores = block.gather(0, gt_rows.unsqueeze(0))
+        ranks[start:end] = (block > gt_scores).sum(0)
+        top1[start:end] = block.argmax(0)
+
+    return ranks, top1
+
+
+def i2t(sims, return_top1=False, block_size=1024):
+    """
+    (images, captions)
+    """
+    ranks, top1 = i2t_ranks(sims, block_size=block_size)
+    metrics = ranks_to_metrics(ranks)
+
+    if return_top1:
+        return metrics, layers.tensor_to_numpy(top1)
+
+    return metrics
+
+
+def t2i(sims, return_top1=False, block_size=1024):
     """
     (images, captions)
     """
+    ranks, top1 = t2i_ranks(sims, block_size=block_size)
+    metrics = ranks_to_metrics(ranks)
+
+    if return_top1:
+        return metrics, layers.tensor_to_numpy(top1)
+
+    return metrics
 
+
+def i2t_numpy(sims, return_top1=False):
+    """
+    (images, captions)
+    """
     npts, ncaps = sims.shape
     captions_per_image = ncaps // npts
 
@@ -157,10 +1278,13 @@ def i2t(sims,):
     medr = np.floor(np.median(ranks)) + 1
     meanr = ranks.mean() + 1
 
+    if return_top1:
+        return (r1, r5, r10, medr, meanr), top1
+
     return (r1, r5, r10, medr, meanr)
 
 
-def t2i(sims,):
+def t2i_numpy(sims, return_top1=False):
     """
     (images, captions)
     """
@@ -186,4 +1310,7 @@ def t2i(sims,):
     medr = np.floor(np.median(ranks)) + 1
     meanr = ranks.mean() + 1
 
+    if return_top1:
+        return (r1, r5, r10, medr, meanr), top1
+
     return (r1, r5, r10, medr, meanr)
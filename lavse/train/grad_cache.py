@@ -0,0 +1,109 @@
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from addict import Dict
+
+from ..model.loss import cat_padded
+
+
+def slice_batch(batch, start, end):
+    """
+    Samples [start, end) of a collated batch
+
+    Tensors, arrays and lists are sliced along their first dimension,
+    tuples (e.g., (captions, lengths)) are sliced element-wise.
+    """
+    if isinstance(batch, dict):
+        return Dict({k: slice_batch(v, start, end) for k, v in batch.items()})
+    if isinstance(batch, tuple):
+        return tuple(slice_batch(x, start, end) for x in batch)
+    if torch.is_tensor(batch) or isinstance(batch, (np.ndarray, list)):
+        return batch[start:end]
+    return batch
+
+
+class RandomState:
+    """
+    CPU and CUDA RNG states, so a sub-batch can be re-forwarded with
+    the same dropout masks
+    """
+
+    def __init__(self):
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_states = None
+        if torch.cuda.is_available():
+            self.cuda_states = torch.cuda.get_rng_state_all()
+
+    def restore(self):
+        torch.set_rng_state(self.cpu_state)
+        if self.cuda_states is not None:
+            torch.cuda.set_rng_state_all(self.cuda_states)
+
+
+def grad_cache_loss(model, batch, sub_batch_size, scaler=None, autocast=None):
+    """
+    Multimodal loss of a large batch with bounded activation memory
+    (gradient caching). Gradients are accumulated in the model and the
+    loss is returned detached.
+
+    1. sub-batches are embedded without a graph
+    2. the loss of the whole batch is computed from these embeddings,
+       then backpropagated down to them only
+    3. every sub-batch is embedded again (same RNG state) with a graph
+       and the cached embedding gradients are backpropagated through it
+
+    Encoders are forwarded twice per sub-batch, so BatchNorm layers in
+    train mode update their running statistics twice per step.
+
+    scaler: GradScaler of mixed precision training, the cached
+        gradients are then gradients of the scaled loss
+    autocast: callable returning the autocast context of mixed
+        precision training. Only the forward passes run under it,
+        the backward passes never do.
+    """
+    autocast = autocast or nullcontext
+    n = len(batch['image'])
+    sub_batches, states = [], []
+    img_embs, cap_embs = [], []
+
+    with torch.no_grad(), autocast():
+        for start in range(0, n, sub_batch_size):
+            sub_batch = slice_batch(batch, start, min(start + sub_batch_size, n))
+            states.append(RandomState())
+            img_emb, cap_emb = model.forward_batch(sub_batch)
+            sub_batches.append(sub_batch)
+            img_embs.append(img_emb)
+            cap_embs.append(cap_emb)
+
+    img_emb = cat_padded(img_embs).requires_grad_()
+    cap_emb = cat_padded(cap_embs).requires_grad_()
+    _, lens = batch['caption']
+
+    with autocast():
+        loss = model.compute_multimodal_loss(img_emb, cap_emb, lens)
+    if scaler is not None:
+        scaler.scale(loss).backward()
+    else:
+        loss.backward()
+
+    devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+    start = 0
+    for sub_batch, state, sub_img, sub_cap in zip(sub_batches, states, img_embs, cap_embs):
+        end = start + len(sub_img)
+        # Continue the global RNG from where the first pass left it
+        with torch.random.fork_rng(devices=devices), autocast():
+            state.restore()
+            sub_img, sub_cap = model.forward_batch(sub_batch)
+
+        img_grad = img_emb.grad[start:end]
+        cap_grad = cap_emb.grad[start:end]
+        if sub_img.dim() == 3:
+            img_grad = img_grad[:, :sub_img.shape[1]]
+        if sub_cap.dim() == 3:
+            cap_grad = cap_grad[:, :sub_cap.shape[1]]
+
+        torch.autograd.backward([sub_img, sub_cap], [img_grad, cap_grad])
+        start = end
+
+    return loss.detach()
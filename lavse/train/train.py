@@ -2,6 +2,7 @@ import json
 import logging
 import os
 import random
+import warnings
 from pathlib import Path
 from timeit import default_timer as dt
 
@@ -14,6 +15,10 @@ from addict import Dict
 from tqdm import tqdm
 
 from . import evaluation
+from .async_eval import AsyncEvaluator
+from .embedding_cache import EmbeddingCache
+from .grad_cache import grad_cache_loss
+from ..data import loaders, samplers
 from ..data.loaders import DataIterator
 from ..utils import file_utils, helper, layers, logger
 from .lr_scheduler import get_scheduler
@@ -21,6 +26,18 @@ from .lr_scheduler import get_scheduler
 torch.manual_seed(0)
 random.seed(0, version=2)
 
+def get_amp_dtype(amp, device):
+    """
+    Autocast dtype of the amp option: True picks float16 on GPUs and
+    bfloat16 on CPUs (the only one CPU autocast supports)
+    """
+    if not amp:
+        return None
+    if amp is True:
+        return torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return getattr(torch, amp)
+
+
 def freeze(module):
      for x in module.parameters():
          x.requires_grad = False
@@ -46,6 +63,8 @@ class Trainer:
         self.metrics = {}
         self.master = master
         self.val_metric = 'rsum'
+        self.async_evaluator = None
+        self.setup_eval()
 
     def setup_optim(
         self,
@@ -58,8 +77,18 @@ class Trainer:
         save_all=False,
         freeze_modules=[],
         val_metric='rsum',
+        grad_cache_size=None,
+        amp=False,
         **kwargs
     ):
+        """
+        grad_cache_size: sub-batch size of gradient-cached training
+            (see grad_cache.grad_cache_loss), the whole batch is
+            forwarded at once when None
+        amp: mixed precision training, True or the autocast dtype
+            ('float16'/'bfloat16'). float16 losses are scaled by a
+            GradScaler.
+        """
         from . import optimizers
         count_params = lambda p: np.sum([
             np.product(tuple(x.shape)) for x in p
@@ -109,6 +138,102 @@ class Trainer:
         self.count = early_stop
         self.early_stop = early_stop
         self.val_metric = val_metric
+        self.grad_cache_size = grad_cache_size or None
+        self.setup_amp(amp)
+
+    def setup_amp(self, amp=False):
+        """
+        Autocast dtype and GradScaler of mixed precision training
+        (see setup_optim)
+        """
+        device = torch.device(self.device)
+        self.amp_dtype = get_amp_dtype(amp, device)
+        self.scaler = torch.amp.GradScaler(
+            'cuda', enabled=self.amp_dtype == torch.float16 and device.type == 'cuda'
+        )
+        if self.amp_dtype is not None:
+            self.sysoutlog(f'Mixed precision training: {self.amp_dtype}')
+
+    def autocast(self):
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None,
+        )
+
+    def setup_eval(
+        self,
+        img_batch_size=None,
+        cap_batch_size=None,
+        emb_dtype='float32',
+        streaming=False,
+        sim_on_device=False,
+        shared_size=128,
+        memory_budget=None,
+        folds=None,
+        cache=None,
+        cache_dir=None,
+        background=False,
+        background_device=None,
+        rerank_k=None,
+        sim_dtype=None,
+        precision_guard=1000,
+        sim_workers=1,
+        **kwargs
+    ):
+        """
+        Options used by evaluate_loaders.
+        Batch sizes default to the ones of each validation loader.
+        emb_dtype is the precision used to store the embeddings.
+        streaming avoids the full similarity matrix (no val_loss).
+        sim_on_device keeps the similarity matrix in the eval device.
+        memory_budget (bytes) autotunes the similarity shard sizes,
+        otherwise shared_size is used.
+        folds (e.g., 5 for COCO 5x1k) adds per-fold and averaged
+        metrics computed from the same similarity matrix.
+        cache ('images', 'captions' or a list of both) reuses the
+        embeddings of encoders unchanged since the last evaluation
+        (e.g., frozen by freeze_modules), optionally saved in cache_dir.
+        background runs validation of weight snapshots in a separate
+        process (in background_device) while training continues.
+        rerank_k (shortlist size or list of sizes) evaluates the
+        two-stage retrieval instead of scoring every pair.
+        sim_dtype ('float16'/'bfloat16') computes similarities in
+        reduced precision. Unless streaming, precision_guard sampled
+        queries are rescored in float32 to report the recall delta.
+        sim_workers threads score the similarity blocks on CPU.
+        """
+        self.img_batch_size = img_batch_size
+        self.cap_batch_size = cap_batch_size
+        self.emb_dtype = emb_dtype
+        self.streaming = streaming
+        self.sim_on_device = sim_on_device
+        self.shared_size = shared_size
+        self.memory_budget = memory_budget
+        self.folds = folds
+
+        if isinstance(cache, str):
+            cache = [cache]
+        self.cached = tuple(cache or ())
+        self.embedding_cache = None
+        if self.cached:
+            self.embedding_cache = EmbeddingCache(cache_dir=cache_dir)
+
+        self.rerank_k = rerank_k
+        self.sim_dtype = sim_dtype
+        self.precision_guard = precision_guard
+        self.sim_workers = sim_workers
+        self.background = background
+        self.background_device = background_device
+        self.eval_options = dict(
+            img_batch_size=img_batch_size, cap_batch_size=cap_batch_size,
+            emb_dtype=emb_dtype, streaming=streaming,
+            sim_on_device=sim_on_device, shared_size=shared_size,
+            memory_budget=memory_budget, folds=folds,
+            cache=cache, cache_dir=cache_dir, rerank_k=rerank_k,
+            sim_dtype=sim_dtype, precision_guard=precision_guard,
+            sim_workers=sim_workers,
+        )
 
     def fit(
         self, train_loader, valid_loaders, lang_loaders=[],
@@ -131,6 +256,20 @@ class Trainer:
         self.train_iter = None
         self.lang_iters = {}
 
+        self.async_evaluator = None
+        if self.background and self.master:
+            tokenizers = valid_loaders[0].dataset.tokenizers
+            if type(tokenizers) != list:
+                tokenizers = [tokenizers]
+            self.async_evaluator = AsyncEvaluator(
+                model_args=self.args.model,
+                tokenizers=tokenizers,
+                valid_loaders=valid_loaders,
+                eval_options=self.eval_options,
+                val_metric=self.val_metric,
+                device=self.background_device or self.device,
+            )
+
         pbar = lambda x: range(x)
         if self.master:
             pbar = lambda x: tqdm(range(x), desc='Epochs')
@@ -151,12 +290,82 @@ class Trainer:
             if not continue_training:
                 break
 
+        if self.async_evaluator is not None:
+            # Wait for the last validation rounds
+            self.process_background(wait=True)
+            self.async_evaluator.close()
+
+    def forward_backward(self, batch, lang_iters=()):
+        """
+        Losses of a training batch, backpropagated into the model
+        gradients (scaled by self.scaler). Only the forward passes run
+        under autocast, the backward passes never do.
+
+        Returns (multimodal_loss, total_loss, loss_info)
+        """
+        if self.grad_cache_size:
+            # Backpropagated already, sub-batch by sub-batch
+            multimodal_loss = grad_cache_loss(
+                self.model, batch, self.grad_cache_size,
+                scaler=self.scaler, autocast=self.autocast,
+            )
+        else:
+            with self.autocast():
+                multimodal_loss = self.model.forward_multimodal_loss(batch)
+
+        # Cross-language update
+        total_lang_loss = 0.
+        loss_info = {}
+        for lang_iter in lang_iters:
+
+            lang_data = lang_iter.next()
+            with self.autocast():
+                lang_loss = self.model.forward_multilanguage_loss(*lang_data)
+            total_lang_loss += lang_loss
+            loss_info[f'train_loss_{str(lang_iter)}'] = lang_loss
+
+        total_loss = multimodal_loss + total_lang_loss
+        if not self.grad_cache_size:
+            self.scaler.scale(total_loss).backward()
+        elif torch.is_tensor(total_lang_loss):
+            self.scaler.scale(total_lang_loss).backward()
+
+        return multimodal_loss, total_loss, loss_info
+
+    def update_batch_sampler(self, train_loader, epoch):
+        """
+        Recluster the training images of a HardNegativeBatchSampler
+        with the current image embeddings when it is due
+        """
+        batch_sampler = train_loader.batch_sampler
+        if not hasattr(batch_sampler, 'refresh'):
+            return
+
+        batch_sampler.set_epoch(epoch)
+        if not batch_sampler.needs_refresh(epoch):
+            return
+
+        img_loader = loaders.get_image_loader(
+            train_loader,
+            batch_size=self.img_batch_size or batch_sampler.batch_size,
+        )
+        # Training-time random augmentations would blur the clusters
+        with samplers.transform_override(
+            train_loader.dataset, batch_sampler.eval_transform,
+        ):
+            img_embs = evaluation.predict_images(self.model, img_loader)
+        if img_embs.ndim == 3:
+            img_embs = img_embs.mean(1)
+        batch_sampler.refresh(img_embs, device=self.device)
+
     def train_epoch(
         self, train_loader, lang_loaders,
         epoch, valid_loaders=[], log_interval=50,
         valid_interval=500, path=''
     ):
 
+        self.update_batch_sampler(train_loader, epoch)
+
         lang_iters = [
             DataIterator(
                 loader=loader,
@@ -174,6 +383,12 @@ class Trainer:
                 leave=False,
             )
 
+        use_cuda = torch.device(self.device).type == 'cuda'
+        if use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        # Throughput and peak memory are measured between logging steps
+        log_begin, log_samples = dt(), 0
+
         for batch in pbar(train_loader):
             self.model.train()
 
@@ -181,35 +396,32 @@ class Trainer:
             self.optimizer.zero_grad()
 
             begin_forward = dt()
+            log_samples += len(batch['image'])
 
-            multimodal_loss = self.model.forward_multimodal_loss(batch)
+            multimodal_loss, total_loss, loss_info = self.forward_backward(
+                batch, lang_iters,
+            )
             iteration = self.model.multimodal_criterion.iteration
             adjusted_iter = self.world_size * iteration
 
-            # Cross-language update
-            total_lang_loss = 0.
-            loss_info = {}
-            for lang_iter in lang_iters:
-
-                lang_data = lang_iter.next()
-                lang_loss = self.model.forward_multilanguage_loss(*lang_data)
-                total_lang_loss += lang_loss
-                loss_info[f'train_loss_{str(lang_iter)}'] = lang_loss
-
-            total_loss = multimodal_loss + total_lang_loss
-            total_loss.backward()
-
             norm = 0.
             if self.clip_grad > 0:
+                # Clip the true gradients, not the scaled ones
+                self.scaler.unscale_(self.optimizer)
                 norm = clip_grad_norm_(
                     self.model.parameters(),
                     self.clip_grad
                 )
 
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
             if self.lr_scheduler is not None:
                 self.lr_scheduler.step()
 
+            log_step = iteration % log_interval == 0
+            if log_step and use_cuda:
+                # Only synchronize when the timings are reported
+                torch.cuda.synchronize(self.device)
             end_backward = dt()
             batch_time = end_backward-begin_forward
 
@@ -225,6 +437,16 @@ class Trainer:
             })
 
             train_info.update(loss_info)
+            if log_step:
+                train_info['samples_per_sec'] = log_samples / (end_backward - log_begin)
+                if use_cuda:
+                    train_info['max_memory_mb'] = (
+                        torch.cuda.max_memory_allocated(self.device) / 2**20
+                    )
+                    torch.cuda.reset_peak_memory_stats(self.device)
+                log_begin, log_samples = dt(), 0
+            if self.scaler.is_enabled():
+                train_info['amp_scale'] = self.scaler.get_scale()
 
             for param_group in self.optimizer.param_groups:
                 if 'name' in param_group:
@@ -238,35 +460,21 @@ class Trainer:
                     iteration=iteration, prefix='train'
                 )
 
-            if iteration % valid_interval == 0:
-
-                # Run evaluation
-                metrics, metric_value = self.evaluate_loaders(valid_loaders)
-
-                # Update early stop variables
-                # and save checkpoint
-                if metric_value < self.best_val:
-                    self.count -= 1
-                elif not self.save_all:
-                    self.count = self.early_stop
-                    self.best_val = metric_value
-
-                if self.master:
-                    self.save(
-                        path=self.path,
-                        is_best=(metric_value >= self.best_val),
-                        args=self.args,
-                        rsum=metric_value,
-                    )
+            if self.async_evaluator is not None:
+                if not self.process_background():
+                    return False
 
-                    # Log updates
-                    for metric, values in metrics.items():
-                        self.tb_writer.add_scalar(metric, values, iteration)
+            if iteration % valid_interval == 0:
 
-                # Early stop
-                if self.count == 0 and self.master:
-                    self.sysoutlog('\n\nEarly stop\n\n')
-                    return False
+                if self.async_evaluator is not None:
+                    self.async_evaluator.submit(iteration, self.model)
+                elif not self.background:
+                    # Run evaluation
+                    metrics, metric_value = self.evaluate_loaders(valid_loaders)
+                    if not self.update_validation(
+                        metrics, metric_value, iteration
+                    ):
+                        return False
 
             if iteration % log_interval == 0 and self.master:
                 helper.print_tensor_dict(train_info, print_fn=self.sysoutlog)
@@ -278,6 +486,60 @@ class Trainer:
                     )
         return True
 
+    def update_validation(
+        self, metrics, metric_value, iteration, model_state=None,
+    ):
+        """
+        Update early stop variables, save checkpoint and log the
+        metrics of a validation round. Returns False to stop training.
+
+        model_state: evaluated weights, when they are not the
+            current ones (background validation)
+        """
+        if metric_value < self.best_val:
+            self.count -= 1
+        elif not self.save_all:
+            self.count = self.early_stop
+            self.best_val = metric_value
+
+        if self.master:
+            self.save(
+                path=self.path,
+                is_best=(metric_value >= self.best_val),
+                args=self.args,
+                rsum=metric_value,
+                iteration=iteration,
+                model_state=model_state,
+            )
+
+            # Log updates
+            for metric, values in metrics.items():
+                self.tb_writer.add_scalar(metric, values, iteration)
+
+        # Early stop
+        if self.count == 0 and self.master:
+            self.sysoutlog('\n\nEarly stop\n\n')
+            return False
+
+        return True
+
+    def process_background(self, wait=False):
+        """
+        Handle validation rounds finished by the background worker
+        """
+        continue_training = True
+        for iteration, metrics, metric_value, state in (
+            self.async_evaluator.poll(wait=wait)
+        ):
+            self.sysoutlog(f'Validation of iteration {iteration}')
+            for k, v in metrics.items():
+                self.sysoutlog(f'{k:<10s}: {v:>6.1f}')
+
+            continue_training &= self.update_validation(
+                metrics, metric_value, iteration, model_state=state,
+            )
+        return continue_training
+
     def evaluate_loaders(self, loaders):
         loader_metrics = {}
         final_sum = 0.
@@ -289,15 +551,7 @@ class Trainer:
             self.sysoutlog(
                 f'Evaluating {i+1:2d}/{nb_loaders:2d} - {loader_name}'
             )
-            img_emb, txt_emb, lens = evaluation.predict_loader(
-                model=self.model, data_loader=loader, device=self.device
-            )
-
-            result = evaluation.evaluate(
-                model=self.model, img_emb=img_emb,
-                txt_emb=txt_emb, lengths=lens,
-                device=self.device, shared_size=128,
-            )
+            result = self.evaluate_loader(loader)
 
             metric_value = result[self.val_metric]
             if 'loss' in self.val_metric:
@@ -316,18 +570,83 @@ class Trainer:
 
         return loader_metrics, final_sum/float(nb_loaders)
 
+    def evaluate_loader(self, loader):
+        """
+        Metrics of a single validation loader
+        """
+        _, world_size = evaluation.get_rank_and_world_size()
+        if world_size > 1:
+            ignored = [
+                name for name, value in (
+                    ('streaming', self.streaming),
+                    ('rerank_k', self.rerank_k),
+                    ('sim_dtype', self.sim_dtype),
+                    ('cache', self.embedding_cache),
+                )
+                if value
+            ]
+            if ignored:
+                warnings.warn(
+                    'Distributed evaluation ignores the eval options '
+                    f'{ignored}, ranks are always streamed in float32'
+                )
+            return evaluation.evaluate_distributed(
+                model=self.model, data_loader=loader, device=self.device,
+                img_batch_size=self.img_batch_size,
+                cap_batch_size=self.cap_batch_size,
+                dtype=self.emb_dtype, shared_size=self.shared_size,
+                memory_budget=self.memory_budget, folds=self.folds,
+            )
+
+        img_emb, txt_emb, lens = evaluation.predict_loader(
+            model=self.model, data_loader=loader, device=self.device,
+            img_batch_size=self.img_batch_size,
+            cap_batch_size=self.cap_batch_size,
+            dtype=self.emb_dtype,
+            cache=self.embedding_cache, cached=self.cached,
+        )
+
+        if self.rerank_k:
+            return evaluation.evaluate_rerank(
+                model=self.model, img_emb=img_emb,
+                txt_emb=txt_emb, lengths=lens,
+                device=self.device, rerank_k=self.rerank_k,
+            )
+
+        if self.streaming:
+            return evaluation.evaluate_streaming(
+                model=self.model, img_emb=img_emb,
+                txt_emb=txt_emb, lengths=lens,
+                device=self.device, shared_size=self.shared_size,
+                memory_budget=self.memory_budget, folds=self.folds,
+                sim_dtype=self.sim_dtype,
+            )
+
+        return evaluation.evaluate(
+            model=self.model, img_emb=img_emb,
+            txt_emb=txt_emb, lengths=lens,
+            device=self.device, shared_size=self.shared_size,
+            memory_budget=self.memory_budget,
+            sim_on_device=self.sim_on_device, folds=self.folds,
+            sim_dtype=self.sim_dtype, precision_guard=self.precision_guard,
+            num_workers=self.sim_workers,
+        )
+
     def save(
         self, path=None,
         is_best=False, args=None,
+        iteration=None,
         **kwargs
     ):
+        if iteration is None:
+            iteration = self.model.multimodal_criterion.iteration
 
         helper.save_checkpoint(
             path, self.model,
             optimizer=self.optimizer,
             is_best=is_best,
             save_all=self.save_all,
-            iteration=self.model.multimodal_criterion.iteration,
+            iteration=iteration,
             args=self.args,
             **kwargs
         )
@@ -1,4 +1,5 @@
 from . import helper 
 from . import logger 
 from . import file_utils
-from . import layers
\ No newline at end of file
+from . import layers
+from . import ragged
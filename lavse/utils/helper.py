@@ -5,14 +5,21 @@ from tensorboardX import SummaryWriter
 
 def save_checkpoint(
         outpath, model, optimizer=None,
-        is_best=False, save_all=False, **kwargs
+        is_best=False, save_all=False, model_state=None, **kwargs
     ):
+    '''
+        model_state: weights saved instead of the current
+            model weights (e.g., a snapshot evaluated in background)
+    '''
 
     if hasattr(model, 'module'):
         model = model.module
 
+    if model_state is None:
+        model_state = model.state_dict()
+
     state_dict = {
-        'model': model.state_dict(),
+        'model': model_state,
         'optimizer': optimizer.state_dict(),
     }
 
@@ -0,0 +1,162 @@
+import numpy as np
+import torch
+
+
+def lengths_to_offsets(lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return offsets
+
+
+class RaggedEmbeddings:
+    """
+        Variable-length sequences stored without padding.
+
+        data: (total_length, d) matrix with every sequence concatenated
+        offsets: (n + 1) array, sequence i is data[offsets[i]:offsets[i+1]]
+
+        Both can be numpy arrays or torch tensors. Offsets are always
+        kept in the host, so indexing never synchronizes a device.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_padded(cls, padded, lengths):
+        """
+            padded: (n, max_length, d) numpy array or tensor
+            lengths: n valid lengths
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        max_length = padded.shape[1]
+        mask = np.arange(max_length)[None, :] < lengths[:, None]
+        if torch.is_tensor(padded):
+            mask = torch.from_numpy(mask).to(padded.device)
+        # Boolean indexing keeps the row-major order,
+        # i.e., sequences are concatenated one after another
+        return cls(padded[mask], lengths_to_offsets(lengths))
+
+    @classmethod
+    def concatenate(cls, chunks):
+        """
+            Concatenate a list of RaggedEmbeddings (numpy or torch)
+        """
+        lengths = np.concatenate([x.lengths_array for x in chunks])
+        if torch.is_tensor(chunks[0].data):
+            data = torch.cat([x.data for x in chunks], 0)
+        else:
+            data = np.concatenate([x.data for x in chunks], 0)
+        return cls(data, lengths_to_offsets(lengths))
+
+    @property
+    def lengths_array(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def lengths(self):
+        return self.lengths_array.tolist()
+
+    @property
+    def max_length(self):
+        if len(self) == 0:
+            return 0
+        return int(self.lengths_array.max())
+
+    @property
+    def dim(self):
+        return self.data.shape[-1]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def device(self):
+        if torch.is_tensor(self.data):
+            return self.data.device
+        return torch.device('cpu')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, 'RaggedEmbeddings only support contiguous slices'
+            stop = max(start, stop)
+            begin, end = self.offsets[start], self.offsets[stop]
+            return RaggedEmbeddings(
+                self.data[begin:end],
+                self.offsets[start:stop+1] - begin,
+            )
+
+        if index < 0:
+            index += len(self)
+        begin, end = self.offsets[index], self.offsets[index+1]
+        return self.data[begin:end]
+
+    def take(self, index):
+        """
+            Sequences at `index` (any order, repetitions allowed)
+        """
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.lengths_array[index]
+        offsets = lengths_to_offsets(lengths)
+        rows = (
+            np.repeat(self.offsets[index] - offsets[:-1], lengths)
+            + np.arange(offsets[-1])
+        )
+        if torch.is_tensor(self.data):
+            rows = torch.from_numpy(rows).to(self.data.device)
+        return RaggedEmbeddings(self.data[rows], offsets)
+
+    def to(self, device=None, dtype=None):
+        """
+            Torch version of the sequences in `device` and `dtype`
+        """
+        data = self.data
+        if not torch.is_tensor(data):
+            data = torch.from_numpy(np.ascontiguousarray(data))
+        data = data.to(device=device, dtype=dtype)
+        return RaggedEmbeddings(data, self.offsets)
+
+    def numpy(self, dtype=None):
+        data = self.data
+        if torch.is_tensor(data):
+            data = data.data.cpu().numpy()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return RaggedEmbeddings(data, self.offsets)
+
+    def pad(self, max_length=None):
+        """
+            Padded (n, max_length, d) version of the sequences
+            and their lengths. Padded positions are filled with zeros.
+        """
+        lengths = self.lengths_array
+        if max_length is None:
+            max_length = self.max_length
+        n, total = len(self), len(self.data)
+
+        rows = np.repeat(np.arange(n), lengths)
+        cols = np.arange(total) - np.repeat(self.offsets[:-1], lengths)
+
+        if torch.is_tensor(self.data):
+            padded = self.data.new_zeros(n, max_length, self.dim)
+            rows = torch.from_numpy(rows).to(self.data.device)
+            cols = torch.from_numpy(cols).to(self.data.device)
+        else:
+            padded = np.zeros((n, max_length, self.dim), dtype=self.data.dtype)
+
+        padded[rows, cols] = self.data
+        return padded, lengths.tolist()
+
+    def __repr__(self):
+        return (
+            f'RaggedEmbeddings(n={len(self)}, '
+            f'total_length={len(self.data)}, '
+            f'dim={self.dim}, dtype={self.dtype})'
+        )
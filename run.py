@@ -23,13 +23,18 @@ import torch.multiprocessing as mp
 def init_distributed_mode(opt):
     opt.distributed = True
 
+    # gloo allows distributed runs (e.g., evaluation) on CPU-only nodes
+    backend = opt.misc.dist_backend
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+
     torch.distributed.init_process_group(
-        'nccl',
+        backend,
         init_method='env://',
         world_size=opt.ngpu,
         rank=opt.local_rank,
     )
-    setup_for_distributed(opt.rank == 0)
+    setup_for_distributed(opt.local_rank == 0)
 
 
 def setup_for_distributed(is_master):
@@ -166,7 +171,7 @@ if __name__ == '__main__':
         ))
 
     # Distributed data parallel training
-    if opt.misc.distributed:
+    if opt.misc.distributed and torch.cuda.is_available():
         device = torch.device('cuda:{}'.format(opt.local_rank))
         model = model.to(device)
         model = data_parallel.DistributedDataParallel(
@@ -174,6 +179,10 @@ if __name__ == '__main__':
                output_device=opt.local_rank,
         )
         model.set_device(device)
+    elif opt.misc.distributed:
+        device = torch.device('cpu')
+        model = data_parallel.DistributedDataParallel(model)
+        model.set_device(device)
         # model = data_parallel.DistributedDataParallel(model)
     # Standard Data parallel + Single gpu
     else:
@@ -187,14 +196,16 @@ if __name__ == '__main__':
         print(device)
         model = model.to(device)
 
-    is_master = True
+    is_master = not opt.misc.distributed or opt.local_rank == 0
     model.master = is_master # FIXME: Replace "if print" by built_in print
     print_fn = (lambda x: x) if not is_master else tqdm.write
 
     trainer = train.Trainer(
         model=model,
+        device=device,
         args=opt,
         sysoutlog=print_fn,
+        master=is_master,
     )
 
     trainer.setup_optim(
@@ -207,9 +218,13 @@ if __name__ == '__main__':
         freeze_modules=opt.model.freeze_modules,
         early_stop=opt.engine.early_stop,
         save_all=opt.engine.save_all,
-        val_metric=opt.engine.val_metric if opt.engine.val_metric else 'rsum'
+        val_metric=opt.engine.val_metric if opt.engine.val_metric else 'rsum',
+        grad_cache_size=opt.engine.grad_cache_size,
+        amp=opt.engine.amp,
     )
 
+    trainer.setup_eval(**opt.engine.eval)
+
     if opt.engine.eval_before_training:
         result, rs = trainer.evaluate_loaders(
             val_loaders
@@ -89,6 +89,8 @@ if __name__ == '__main__':
         sysoutlog=print_fn,
     )
 
+    trainer.setup_eval(**opt.engine.eval)
+
     result, rs = trainer.evaluate_loaders(
         loaders
     )
@@ -0,0 +1,86 @@
+import pytest
+import torch
+import torch.nn as nn
+from addict import Dict
+
+from lavse.model import loss
+from lavse.model.model import LAVSE
+from lavse.model.similarity.similarity import Cosine, StackedAttention
+
+
+class SimilarityModel(nn.Module):
+    """
+    LAVSE pairwise/loss drivers around a similarity, without encoders
+    """
+
+    iter_pairwise_similarity = LAVSE.iter_pairwise_similarity
+    _pairwise_setup = LAVSE._pairwise_setup
+    threaded_pairwise_similarity = LAVSE.threaded_pairwise_similarity
+    compute_pairwise_similarity = LAVSE.compute_pairwise_similarity
+    batch_similarity = LAVSE.batch_similarity
+    compute_multimodal_loss = LAVSE.compute_multimodal_loss
+
+    def __init__(self, similarity, criterion=None):
+        super().__init__()
+        self.master = False
+        self.train_memory_budget = None
+        self.__dict__['similarity'] = similarity
+        self.__dict__['multimodal_criterion'] = (
+            criterion or loss.ContrastiveLoss()
+        )
+
+
+class LinearModel(SimilarityModel):
+    """
+    Linear encoders with dropout, batches as produced by Collate
+    with precomputed caption features
+    """
+
+    def __init__(self, in_dim=12, latent_size=8, criterion=None):
+        super().__init__(Cosine(), criterion)
+        self.img_enc = nn.Sequential(nn.Linear(in_dim, latent_size), nn.Dropout(0.2))
+        self.txt_enc = nn.Sequential(nn.Linear(in_dim, latent_size), nn.Dropout(0.2))
+
+    def forward_batch(self, batch):
+        captions, _ = batch['caption']
+        return self.img_enc(batch['image']), self.txt_enc(captions)
+
+
+@pytest.fixture
+def word_embeddings():
+    """
+    Region and padded word embeddings of 30 images with 5 captions each
+    """
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn(30, 5, 16, generator=generator)
+    lengths = torch.randint(3, 9, (150,), generator=generator)
+    captions = torch.randn(150, int(lengths.max()), 16, generator=generator)
+    return images, captions, lengths.tolist()
+
+
+@pytest.fixture
+def cosine_model():
+    return SimilarityModel(Cosine()).eval()
+
+
+@pytest.fixture
+def scan_model():
+    return SimilarityModel(StackedAttention(
+        i2t=False, feature_norm='clipped_l2norm', smooth=9,
+        agg_function='Mean', chunk_size=4,
+    )).eval()
+
+
+@pytest.fixture
+def linear_model():
+    torch.manual_seed(0)
+    return LinearModel()
+
+
+@pytest.fixture
+def linear_batch():
+    generator = torch.Generator().manual_seed(1)
+    return Dict(
+        image=torch.randn(24, 12, generator=generator),
+        caption=(torch.randn(24, 12, generator=generator), [1] * 24),
+    )
@@ -0,0 +1,12 @@
+import torch.nn as nn
+
+from lavse.train.async_eval import snapshot_state
+
+
+def test_snapshot_only_strips_leading_module_prefix():
+    wrapped = nn.DataParallel(nn.ModuleDict({
+        'txt_enc': nn.ModuleDict({'module': nn.Linear(2, 2)}),
+    }))
+    state = snapshot_state(wrapped)
+    assert set(state) == {'txt_enc.module.weight', 'txt_enc.module.bias'}
+    assert all(x.device.type == 'cpu' for x in state.values())
@@ -0,0 +1,52 @@
+from lavse.model.similarity import autotune
+
+
+def block_bytes(similarity, images, captions, img_size, cap_size):
+    pair_bytes, img_bytes, cap_bytes = similarity.pair_cost(images, captions)
+    return img_size * img_bytes + cap_size * (cap_bytes + img_size * pair_bytes)
+
+
+def test_parse_memory():
+    assert autotune.parse_memory('512MB') == 512 * 2**20
+    assert autotune.parse_memory('1e6') == 10**6
+    assert autotune.parse_memory(None) is None
+
+
+def test_shard_sizes_fit_budget(scan_model, word_embeddings):
+    images, captions, _ = word_embeddings
+    similarity = scan_model.similarity
+
+    img_size, cap_size = autotune.autotune_shard_sizes(
+        similarity, images, captions, memory_budget=200_000,
+    )
+    assert 8 <= img_size <= len(images)
+    assert 8 <= cap_size <= len(captions)
+    assert block_bytes(similarity, images, captions, img_size, cap_size) <= 200_000
+
+
+def test_shard_sizes_follow_shapes_and_dtype(scan_model, word_embeddings):
+    images, captions, _ = word_embeddings
+    similarity = scan_model.similarity
+    budget = 200_000
+
+    sizes = autotune.autotune_shard_sizes(similarity, images, captions, budget)
+    short = autotune.autotune_shard_sizes(similarity, images, captions[:, :3], budget)
+    double = autotune.autotune_shard_sizes(
+        similarity, images.double(), captions.double(), budget,
+    )
+
+    autotune._shard_sizes.clear()
+    assert short == autotune.autotune_shard_sizes(
+        similarity, images, captions[:, :3], budget,
+    )
+    assert double == autotune.autotune_shard_sizes(
+        similarity, images.double(), captions.double(), budget,
+    )
+    assert sizes != double
+
+
+def test_too_small_budget_uses_min_blocks(scan_model, word_embeddings):
+    images, captions, _ = word_embeddings
+    assert autotune.autotune_shard_sizes(
+        scan_model.similarity, images, captions, memory_budget=1000,
+    ) == (8, 8)
@@ -0,0 +1,42 @@
+from lavse.data.datasets import CaptionView, ImageView
+
+
+class CaptionDataset:
+    """
+    23 captions, 5 per image (the last image has 3 captions)
+    """
+
+    captions_per_image = 5
+
+    def get_image(self, index):
+        img_id = index // self.captions_per_image
+        return f'image-{img_id}', img_id
+
+    def get_caption(self, index):
+        return f'caption-{index}'
+
+    def __len__(self):
+        return 23
+
+
+def test_image_view_visits_each_image_once():
+    view = ImageView(CaptionDataset())
+    assert len(view) == 5
+    assert [view[i]['img_id'] for i in range(len(view))] == [0, 1, 2, 3, 4]
+
+    view = ImageView(CaptionDataset(), start=3, end=10)
+    assert len(view) == 2
+    item = view[0]
+    assert item['index'] == 0 and item['img_id'] == 3 and item['image'] == 'image-3'
+
+    assert len(ImageView(CaptionDataset(), start=6)) == 0
+
+
+def test_caption_view_range():
+    view = CaptionView(CaptionDataset(), start=20, end=30)
+    assert len(view) == 3
+    assert [view[i]['caption'] for i in range(3)] == [
+        'caption-20', 'caption-21', 'caption-22',
+    ]
+    assert view[0]['index'] == 0
+    assert len(CaptionView(CaptionDataset())) == 23
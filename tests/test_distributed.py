@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from addict import Dict
+from torch.utils.data import DataLoader, Dataset
+
+from lavse.model.model import LAVSE
+from lavse.model.similarity.similarity import Cosine
+from lavse.train import evaluation
+
+
+class FeatureDataset(Dataset):
+    """
+    Precomputed image and caption embeddings, 5 captions per image
+    """
+
+    captions_per_image = 5
+
+    def __init__(self, n_images, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.images = torch.randn(n_images, 8, generator=generator)
+        # Captions close to their image, so ranks are not all random
+        self.captions = (
+            self.images.repeat_interleave(5, 0)
+            + torch.randn(n_images * 5, 8, generator=generator)
+        )
+
+    def get_image(self, index):
+        img_id = index // self.captions_per_image
+        return self.images[img_id], img_id
+
+    def get_caption(self, index):
+        return self.captions[index]
+
+    def __len__(self):
+        return len(self.captions)
+
+
+def collate(items):
+    batch = Dict(index=np.array([x['index'] for x in items]))
+    if 'image' in items[0]:
+        batch['image'] = torch.stack([x['image'] for x in items])
+    if 'caption' in items[0]:
+        captions = torch.stack([x['caption'] for x in items])
+        batch['caption'] = (captions, [1] * len(items))
+    return batch
+
+
+class FeatureModel(nn.Module):
+
+    iter_pairwise_similarity = LAVSE.iter_pairwise_similarity
+    _pairwise_setup = LAVSE._pairwise_setup
+
+    def __init__(self):
+        super().__init__()
+        self.master = False
+        self.__dict__['similarity'] = Cosine()
+
+    def embed_images(self, images):
+        return images
+
+    def embed_captions(self, batch):
+        return batch['caption'][0]
+
+
+def get_loader(n_images):
+    return DataLoader(
+        FeatureDataset(n_images), batch_size=5, collate_fn=collate,
+    )
+
+
+def run_rank(rank, world_size, n_images, port, path):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        metrics = evaluation.evaluate_distributed(
+            FeatureModel(), get_loader(n_images), device='cpu',
+            shared_size=(3, 7), folds=2,
+        )
+        with open(os.path.join(path, f'{rank}.json'), 'w') as f:
+            json.dump({k: float(v) for k, v in metrics.items()}, f)
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('n_images,world_size', [(10, 3), (2, 3)])
+def test_distributed_matches_single_process(tmp_path, n_images, world_size):
+    port = 29500 + n_images
+    mp.spawn(
+        run_rank, args=(world_size, n_images, port, str(tmp_path)),
+        nprocs=world_size,
+    )
+
+    dataset = FeatureDataset(n_images)
+    model = FeatureModel()
+    expected = evaluation.evaluate_streaming(
+        model, dataset.images, dataset.captions, [1] * len(dataset),
+        device='cpu', shared_size=(4, 5), folds=2,
+    )
+
+    for rank in range(world_size):
+        with open(os.path.join(tmp_path, f'{rank}.json')) as f:
+            metrics = json.load(f)
+        for key, value in expected.items():
+            if key.endswith('_time'):
+                continue
+            assert metrics[key] == pytest.approx(value), key
@@ -0,0 +1,39 @@
+import numpy as np
+import torch.nn as nn
+
+from lavse.train.embedding_cache import EmbeddingCache, fingerprint_modules
+from lavse.utils.ragged import RaggedEmbeddings
+
+
+def test_disk_round_trip(tmp_path):
+    encoder = nn.Linear(4, 3)
+    fingerprint = fingerprint_modules(encoder)
+    img_embs = np.random.RandomState(0).randn(6, 3).astype(np.float32)
+    cap_embs = RaggedEmbeddings(
+        np.random.RandomState(1).randn(9, 3).astype(np.float16), [0, 2, 5, 9],
+    )
+
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    cache.put('images', fingerprint, img_embs)
+    cache.put('captions', fingerprint, (cap_embs, [2, 3, 4]))
+
+    # A new cache (e.g., another process) only finds them on disk
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    loaded = cache.get('images', fingerprint)
+    np.testing.assert_array_equal(loaded, img_embs)
+
+    loaded, lengths = cache.get('captions', fingerprint)
+    assert lengths == [2, 3, 4]
+    np.testing.assert_array_equal(loaded.data, cap_embs.data)
+    np.testing.assert_array_equal(loaded.offsets, cap_embs.offsets)
+    assert cache.hits == 2 and cache.misses == 0
+
+
+def test_changed_encoder_misses(tmp_path):
+    encoder = nn.Linear(4, 3)
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    cache.put('images', fingerprint_modules(encoder), np.zeros(3))
+
+    nn.init.zeros_(encoder.weight)
+    assert cache.get('images', fingerprint_modules(encoder)) is None
+    assert cache.misses == 1
@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+import torch
+
+from lavse.train import evaluation
+
+
+def tied_sims(n_images, captions_per_image, seed=0):
+    """
+    Random similarities with tied ground truths (captions of the same
+    image) and tied negatives above and below the ground truth, while
+    every row and column keeps a unique maximum
+    """
+    rng = np.random.RandomState(seed)
+    n_captions = n_images * captions_per_image
+    sims = rng.rand(n_images, n_captions)
+    gt = np.arange(n_captions)[None, :] // captions_per_image == np.arange(n_images)[:, None]
+    # Ground truths score higher on average, so ranks are spread
+    sims[gt] += 0.4
+
+    if captions_per_image > 1:
+        first = np.arange(n_images) * captions_per_image
+        sims[np.arange(n_images), first + 1] = sims[np.arange(n_images), first]
+
+    # Second and third best negatives of every row, then of every column
+    for row in range(n_images):
+        negatives = np.where(~gt[row])[0]
+        order = negatives[np.argsort(-sims[row, negatives])]
+        sims[row, order[2]] = sims[row, order[1]]
+    for col in range(n_captions):
+        negatives = np.where(~gt[:, col])[0]
+        order = negatives[np.argsort(-sims[negatives, col])]
+        sims[order[2], col] = sims[order[1], col]
+    return sims
+
+
+@pytest.mark.parametrize('captions_per_image', [1, 5])
+@pytest.mark.parametrize('block_size', [4, 1024])
+def test_rank_engine_matches_numpy_reference(captions_per_image, block_size):
+    sims = tied_sims(12, captions_per_image)
+    assert any(len(np.unique(row)) < len(row) for row in sims)
+    # Ties at the top would make the reference top-1 depend on argsort
+    assert ((sims == sims.max(1, keepdims=True)).sum(1) == 1).all()
+    assert ((sims == sims.max(0, keepdims=True)).sum(0) == 1).all()
+
+    for fast, reference in (
+        (evaluation.i2t, evaluation.i2t_numpy),
+        (evaluation.t2i, evaluation.t2i_numpy),
+    ):
+        metrics, top1 = fast(
+            torch.from_numpy(sims), return_top1=True, block_size=block_size,
+        )
+        expected, expected_top1 = reference(sims, return_top1=True)
+        assert metrics == expected
+        np.testing.assert_array_equal(top1, expected_top1.astype(np.int64))
+
+
+def cosine_embeddings(n_images, captions_per_image=5, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randn(n_images, 8, generator=generator)
+    captions = (
+        images.repeat_interleave(captions_per_image, 0)
+        + torch.randn(n_images * captions_per_image, 8, generator=generator)
+    )
+    return images, captions, [1] * len(captions)
+
+
+def test_dense_fold_metrics(cosine_model):
+    images, captions, lengths = cosine_embeddings(20)
+    metrics, sims = evaluation.evaluate(
+        cosine_model, images, captions, lengths, device='cpu',
+        shared_size=(6, 7), folds=4, return_sims=True,
+    )
+
+    keys = [f'{task}_{k}' for task in ('i2t', 't2i') for k in
+            ('r1', 'r5', 'r10', 'medr', 'meanr')] + ['rsum']
+    all_folds = []
+    for i in range(4):
+        block = sims[i * 5:(i + 1) * 5, i * 25:(i + 1) * 25]
+        i2t_metrics = evaluation.i2t(block)
+        t2i_metrics = evaluation.t2i(block)
+        rsum = np.sum(i2t_metrics[:3]) + np.sum(t2i_metrics[:3])
+        values = list(i2t_metrics) + list(t2i_metrics) + [rsum]
+        all_folds.append(values)
+        for key, value in zip(keys, values):
+            assert metrics[f'fold{i}_{key}'] == pytest.approx(value), key
+
+    for key, value in zip(keys, np.mean(all_folds, 0)):
+        assert metrics[f'folds_{key}'] == pytest.approx(value), key
+
+
+def test_fold_ranges():
+    assert evaluation.get_fold_ranges(10, 50, 2) == [(0, 5, 0, 25), (5, 10, 25, 50)]
+    assert evaluation.get_fold_ranges(10, 50, [(2, 4)]) == [(2, 4, 10, 20)]
+    with pytest.raises(ValueError):
+        evaluation.get_fold_ranges(10, 50, 3)
+
+
+def test_rerank_with_every_candidate_matches_exhaustive(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    images, captions = images.double(), captions.double()
+
+    sims = scan_model.similarity(images, captions, lengths)
+    metrics = evaluation.rerank_metrics(
+        scan_model, images, captions, lengths, rerank_k=[len(captions)],
+    )
+    prefix = f'rerank{len(captions)}_'
+    for task, ranking in (('i2t', evaluation.i2t), ('t2i', evaluation.t2i)):
+        expected = ranking(sims)
+        for name, value in zip(('r1', 'r5', 'r10', 'medr', 'meanr'), expected):
+            assert metrics[f'{prefix}{task}_{name}'] == pytest.approx(value), name
+
+
+def test_pooled_shortlist_holds_pooled_top_k(word_embeddings):
+    images, captions, lengths = word_embeddings
+    img_pooled = evaluation.pool_embeddings(images)
+    cap_pooled = evaluation.pool_embeddings(captions, lengths)
+
+    index, ranks = evaluation.pooled_shortlist(
+        cap_pooled, img_pooled, k=7, block_size=16,
+        gt_fn=lambda rows: (rows // 5).unsqueeze(1),
+    )
+    sims = evaluation.cosine_sim(
+        evaluation.l2norm(cap_pooled, dim=1), evaluation.l2norm(img_pooled, dim=1),
+    )
+    expected = sims.topk(7, dim=1)[1]
+    assert torch.equal(index.sort(1)[0], expected.sort(1)[0])
+    # Ranks of the ground truth among every pooled candidate
+    assert torch.equal(ranks, evaluation.t2i_ranks(sims.t())[0])
+
+
+def test_precision_guard_reports_float32_delta(cosine_model):
+    images, captions, lengths = cosine_embeddings(40, seed=1)
+    reference = evaluation.evaluate(
+        cosine_model, images, captions, lengths, device='cpu',
+    )
+    # Every query is sampled, so the guard covers the whole evaluation
+    metrics = evaluation.evaluate(
+        cosine_model, images, captions, lengths, device='cpu',
+        sim_dtype='bfloat16', precision_guard=1000,
+    )
+
+    for task in ('i2t', 't2i'):
+        for name in ('r1', 'r5', 'r10'):
+            key = f'{task}_{name}'
+            assert metrics[f'precision_{key}_delta'] == pytest.approx(
+                metrics[key] - reference[key]
+            ), key
+    assert 0 < metrics['precision_max_abs_err'] < 0.05
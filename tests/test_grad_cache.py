@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from lavse.train.grad_cache import grad_cache_loss, slice_batch
+
+
+def full_batch_grads(model, batch):
+    img_emb, cap_emb = model.forward_batch(batch)
+    loss = model.compute_multimodal_loss(img_emb, cap_emb, batch['caption'][1])
+    loss.backward()
+    return loss.detach(), {k: p.grad.clone() for k, p in model.named_parameters()}
+
+
+def grad_cache_grads(model, batch, sub_batch_size):
+    loss = grad_cache_loss(model, batch, sub_batch_size)
+    return loss, {k: p.grad.clone() for k, p in model.named_parameters()}
+
+
+def check_equal(expected, actual):
+    (expected_loss, expected_grads), (loss, grads) = expected, actual
+    assert torch.allclose(loss, expected_loss, atol=1e-6)
+    for name, grad in expected_grads.items():
+        assert torch.allclose(grads[name], grad, atol=1e-6), name
+
+
+def test_slice_batch(linear_batch):
+    sub_batch = slice_batch(linear_batch, 4, 9)
+    assert torch.equal(sub_batch['image'], linear_batch['image'][4:9])
+    assert sub_batch['caption'][1] == [1] * 5
+
+
+@pytest.mark.parametrize('sub_batch_size', [1, 5, 24])
+def test_grad_cache_matches_full_batch(linear_model, linear_batch, sub_batch_size):
+    model = linear_model.eval()
+    expected = full_batch_grads(model, linear_batch)
+
+    model.zero_grad()
+    check_equal(expected, grad_cache_grads(model, linear_batch, sub_batch_size))
+
+
+def test_grad_cache_replays_dropout(linear_model, linear_batch):
+    # A single sub-batch draws the same dropout masks as the full batch
+    model = linear_model.train()
+
+    torch.manual_seed(1)
+    expected = full_batch_grads(model, linear_batch)
+    model.zero_grad()
+    torch.manual_seed(1)
+    check_equal(expected, grad_cache_grads(model, linear_batch, 24))
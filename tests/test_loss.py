@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from lavse.model import loss
+
+
+def random_scores(n, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    scores = torch.rand(n, n, generator=generator, dtype=torch.float64)
+    # Positive pairs score higher on average, so some hinges are inactive
+    scores = scores + 0.3 * torch.eye(n, dtype=torch.float64)
+    return scores.requires_grad_()
+
+
+def value_and_grad(criterion, scores):
+    value = criterion(scores)
+    grad, = torch.autograd.grad(value, scores)
+    return value, grad
+
+
+@pytest.mark.parametrize('max_violation', [True, False])
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64])
+def test_fused_matches_dense(max_violation, chunk_size):
+    scores = random_scores(7)
+    params = dict(margin=0.2, max_violation=max_violation, beta=0.5, weight=2.)
+
+    dense_value, dense_grad = value_and_grad(loss.ContrastiveLoss(**params), scores)
+    fused_value, fused_grad = value_and_grad(
+        loss.ContrastiveLoss(fused=True, chunk_size=chunk_size, **params), scores,
+    )
+
+    assert fused_value.dtype == torch.float64
+    assert torch.allclose(fused_value, dense_value, rtol=0, atol=1e-12)
+    assert torch.allclose(fused_grad, dense_grad, rtol=0, atol=1e-12)
+
+
+def test_fused_with_softmax_matches_dense():
+    scores = random_scores(6)
+    params = dict(margin=0.2, max_violation=False, beta=0.5, smooth=10)
+
+    dense_value, dense_grad = value_and_grad(
+        loss.ContrastiveLossWithSoftmax(**params), scores,
+    )
+    fused_value, fused_grad = value_and_grad(
+        loss.ContrastiveLossWithSoftmax(fused=True, chunk_size=4, **params), scores,
+    )
+    assert torch.allclose(fused_value, dense_value, atol=1e-12)
+    assert torch.allclose(fused_grad, dense_grad, atol=1e-12)
+
+
+@pytest.mark.parametrize('k', [0., 0.3, 1.])
+def test_fused_gradcheck(k):
+    scores = random_scores(5, seed=1)
+    assert torch.autograd.gradcheck(
+        lambda x: loss.fused_hinge_loss(x, 0.2, k, chunk_size=2), (scores,),
+    )
+
+
+def test_embedding_queue_keeps_most_recent_pairs():
+    queue = loss.EmbeddingQueue(10)
+    images = torch.arange(12.).view(12, 1)
+    captions = torch.zeros(12, 4, 2)
+    for start, length in zip((0, 4, 8), (2, 4, 3)):
+        queue.enqueue(
+            images[start:start + 4], captions[start:start + 4, :length],
+            [length] * 4,
+        )
+
+    queue_img, queue_cap, queue_lens = queue.embeddings()
+    assert len(queue) == 10
+    assert torch.equal(queue_img, images[2:])
+    # Word embeddings are zero-padded to the longest queued batch
+    assert queue_cap.shape == (10, 4, 2)
+    assert queue_lens == [2] * 2 + [4] * 4 + [3] * 4
+
+    queue.clear()
+    assert len(queue) == 0
+
+
+def test_queue_loss_matches_dense_negatives(linear_model, linear_batch):
+    model = linear_model.eval()
+    model.__dict__['multimodal_criterion'] = loss.ContrastiveLoss(
+        margin=0.2, max_violation=False, beta=1., queue_size=16,
+    )
+    img_emb, cap_emb = model.forward_batch(linear_batch)
+    old, new = slice(0, 16), slice(16, 24)
+    lens = linear_batch['caption'][1]
+
+    model.compute_multimodal_loss(img_emb[old], cap_emb[old], lens[old])
+    value = model.compute_multimodal_loss(img_emb[new], cap_emb[new], lens[new])
+
+    # Batch queries against batch and queued candidates (k = 0: sum of hinges)
+    scores = model.similarity(img_emb, cap_emb)
+    positives = scores.diag()[new]
+    cost_s = (0.2 + scores[new] - positives[:, None]).clamp(min=0)
+    cost_im = (0.2 + scores[:, new] - positives[None, :]).clamp(min=0)
+    diagonal = positives.new_zeros(8, 24, dtype=torch.bool)
+    diagonal[:, new] = torch.eye(8, dtype=torch.bool)
+    expected = (
+        cost_s.masked_fill(diagonal, 0).sum()
+        + cost_im.masked_fill(diagonal.t(), 0).sum()
+    )
+    assert torch.allclose(value, expected, atol=1e-5)
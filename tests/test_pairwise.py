@@ -0,0 +1,35 @@
+import torch
+
+
+def single_call(model, images, captions, lengths):
+    with torch.no_grad():
+        return model.similarity(images, captions, lengths)
+
+
+def test_sharded_matches_single_call(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    expected = single_call(scan_model, images, captions, lengths)
+
+    with torch.no_grad():
+        sims = scan_model.compute_pairwise_similarity(
+            scan_model.similarity, images, captions, lengths,
+            shared_size=(7, 11), async_copy=False,
+        )
+        threaded = scan_model.compute_pairwise_similarity(
+            scan_model.similarity, images, captions, lengths,
+            shared_size=(7, 11), num_workers=2,
+        )
+    assert torch.allclose(sims, expected, atol=1e-5)
+    assert torch.allclose(threaded, sims, atol=1e-6)
+
+
+def test_batch_similarity_under_budget(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    expected = scan_model.batch_similarity(
+        scan_model.similarity, images, captions, lengths,
+    )
+    sharded = scan_model.batch_similarity(
+        scan_model.similarity, images, captions, lengths, memory_budget=200_000,
+    )
+    assert sharded.shape == (30, 150)
+    assert torch.allclose(sharded, expected, atol=1e-5)
@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from lavse.model.similarity.quantized import QuantizedEmbeddings
+
+
+def exact_topk(vectors, queries, k):
+    vectors = vectors / vectors.norm(dim=1, keepdim=True)
+    queries = queries / queries.norm(dim=1, keepdim=True)
+    return queries.mm(vectors.t()).topk(k, dim=1)
+
+
+@pytest.fixture
+def vectors():
+    generator = torch.Generator().manual_seed(0)
+    return (
+        torch.randn(100, 16, generator=generator),
+        torch.randn(6, 16, generator=generator),
+    )
+
+
+@pytest.mark.parametrize('use_packed', [True, False])
+def test_search_approximates_exact_cosine(vectors, use_packed):
+    store, queries = vectors
+    index = QuantizedEmbeddings(store, block_size=16, use_packed=use_packed)
+    assert len(index) == 100
+
+    scores, top = index.search(queries, k=5)
+    exact_scores, _ = exact_topk(store, queries, 5)
+    assert top.shape == (6, 5)
+    # int8 codes only perturb scores, blockwise top-k keeps the best ones
+    assert torch.allclose(scores, exact_scores, atol=0.05)
+    assert (scores[:, 1:] <= scores[:, :-1]).all()
+
+    normalized = store / store.norm(dim=1, keepdim=True)
+    assert torch.allclose(index.dequantize(), normalized, atol=0.01)
+
+
+def test_rescore_is_exact(vectors):
+    store, queries = vectors
+    index = QuantizedEmbeddings(store, block_size=16, keep_float=True)
+
+    scores, top = index.search(queries, k=5, rescore_k=40)
+    exact_scores, exact_top = exact_topk(store, queries, 5)
+    assert torch.equal(top, exact_top)
+    assert torch.allclose(scores, exact_scores, atol=1e-6)
+
+
+def test_rescore_requires_float_vectors(vectors):
+    store, queries = vectors
+    with pytest.raises(ValueError):
+        QuantizedEmbeddings(store).search(queries, k=5, rescore_k=10)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from lavse.utils.ragged import RaggedEmbeddings
+
+
+def padded_sequences(as_tensor):
+    padded = np.random.RandomState(0).randn(4, 5, 3).astype(np.float32)
+    lengths = [2, 5, 1, 3]
+    for i, length in enumerate(lengths):
+        padded[i, length:] = 0
+    if as_tensor:
+        padded = torch.from_numpy(padded)
+    return padded, lengths
+
+
+@pytest.mark.parametrize('as_tensor', [False, True])
+def test_from_padded_round_trip(as_tensor):
+    padded, lengths = padded_sequences(as_tensor)
+    ragged = RaggedEmbeddings.from_padded(padded, lengths)
+
+    assert len(ragged) == 4 and ragged.lengths == lengths
+    assert ragged.max_length == 5 and ragged.dim == 3
+    np.testing.assert_array_equal(ragged[1], padded[1])
+    np.testing.assert_array_equal(ragged[-1], padded[3, :3])
+
+    repadded, repadded_lengths = ragged.pad()
+    assert repadded_lengths == lengths
+    np.testing.assert_array_equal(repadded, padded)
+
+
+@pytest.mark.parametrize('as_tensor', [False, True])
+def test_slice_take_and_concatenate(as_tensor):
+    padded, lengths = padded_sequences(as_tensor)
+    ragged = RaggedEmbeddings.from_padded(padded, lengths)
+
+    head, tail = ragged[:1], ragged[1:]
+    assert tail.lengths == lengths[1:]
+    np.testing.assert_array_equal(tail[0], padded[1])
+    assert len(ragged[3:1]) == 0
+
+    taken = ragged.take([3, 0, 3])
+    assert taken.lengths == [3, 2, 3]
+    np.testing.assert_array_equal(taken[1], padded[0, :2])
+    np.testing.assert_array_equal(taken[2], padded[3, :3])
+
+    joined = RaggedEmbeddings.concatenate([head, tail])
+    np.testing.assert_array_equal(joined.offsets, ragged.offsets)
+    np.testing.assert_array_equal(joined.data, ragged.data)
+
+
+def test_numpy_and_torch_conversions():
+    padded, lengths = padded_sequences(as_tensor=False)
+    ragged = RaggedEmbeddings.from_padded(padded, lengths)
+
+    tensor = ragged.to(dtype=torch.float64)
+    assert torch.is_tensor(tensor.data) and tensor.dtype == torch.float64
+    back = tensor.numpy(np.float32)
+    np.testing.assert_array_equal(back.data, ragged.data)
+    np.testing.assert_array_equal(back.offsets, ragged.offsets)
+
+
+def test_ragged_captions_match_padded(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    ragged = RaggedEmbeddings.from_padded(captions, lengths)
+
+    with torch.no_grad():
+        padded_sims, ragged_sims = [
+            scan_model.compute_pairwise_similarity(
+                scan_model.similarity, images, x, lengths,
+                shared_size=(7, 11), async_copy=False,
+            )
+            for x in (captions, ragged)
+        ]
+    assert torch.allclose(ragged_sims, padded_sims, atol=1e-5)
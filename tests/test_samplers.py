@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+
+from lavse.data.samplers import HardNegativeBatchSampler, transform_override
+
+
+class CaptionDataset:
+
+    captions_per_image = 5
+
+    def __init__(self, n_images):
+        self.n_images = n_images
+        self.transform = 'train'
+
+    def __len__(self):
+        return self.n_images * self.captions_per_image
+
+
+def clustered_embeddings(n_clusters, per_cluster, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(n_clusters, 16, generator=generator)
+    noise = torch.randn(n_clusters * per_cluster, 16, generator=generator)
+    return centers.repeat_interleave(per_cluster, 0) + 0.01 * noise
+
+
+def all_batches(dataset, batch_size, num_replicas=1, **kwargs):
+    samplers = [
+        HardNegativeBatchSampler(
+            dataset, batch_size, num_replicas=num_replicas, rank=rank, **kwargs
+        )
+        for rank in range(num_replicas)
+    ]
+    return samplers, [list(sampler) for sampler in samplers]
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_visits_each_caption_once(drop_last):
+    dataset = CaptionDataset(23)
+    (sampler,), (batches,) = all_batches(dataset, 4, drop_last=drop_last)
+
+    captions = np.concatenate(batches)
+    assert len(np.unique(captions)) == len(captions)
+    if drop_last:
+        assert all(len(batch) == 4 for batch in batches)
+    else:
+        assert sorted(captions) == list(range(len(dataset)))
+    assert len(sampler) == len(batches)
+
+
+def test_no_duplicate_image_in_batch():
+    dataset = CaptionDataset(20)
+    (sampler,), _ = all_batches(dataset, 4)
+    sampler.refresh(clustered_embeddings(5, 4))
+
+    for batch in sampler:
+        images = [index // dataset.captions_per_image for index in batch]
+        assert len(set(images)) == len(images)
+
+
+def test_batches_group_clustered_images():
+    dataset = CaptionDataset(40)
+
+    def mean_clusters(sampler):
+        # Images 4 * c to 4 * c + 3 belong to cluster c
+        return np.mean([
+            len({index // dataset.captions_per_image // 4 for index in batch})
+            for batch in sampler
+        ])
+
+    random_sampler = HardNegativeBatchSampler(dataset, 4, n_clusters=10)
+    sampler = HardNegativeBatchSampler(dataset, 4, n_clusters=10)
+    sampler.refresh(clustered_embeddings(10, 4))
+    assert mean_clusters(sampler) < mean_clusters(random_sampler) - 1
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_ranks_get_equal_batch_counts(drop_last):
+    # 5 rounds of 6 batches: 30 batches do not split over 4 ranks
+    dataset = CaptionDataset(23)
+    samplers, batches = all_batches(dataset, 4, num_replicas=4, drop_last=drop_last)
+
+    expected = 7 if drop_last else 8
+    for sampler, rank_batches in zip(samplers, batches):
+        assert len(rank_batches) == len(sampler) == expected
+
+    captions = np.concatenate([np.concatenate(b) for b in batches])
+    if not drop_last:
+        assert set(captions) == set(range(len(dataset)))
+
+
+def test_transform_override():
+    dataset = CaptionDataset(2)
+    with transform_override(dataset, 'eval'):
+        assert dataset.transform == 'eval'
+    assert dataset.transform == 'train'
+
+    with transform_override(dataset, None):
+        assert dataset.transform == 'train'
@@ -0,0 +1,115 @@
+import pytest
+import torch
+
+from lavse.model.similarity.similarity import (
+    Attention, StackedAttention, cosine_similarity, lengths_to_mask,
+)
+
+
+def test_stacked_attention_keeps_float64(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    sims = scan_model.similarity(images.double(), captions.double(), lengths)
+    assert sims.dtype == torch.float64
+
+    reference = scan_model.similarity(images, captions, lengths)
+    assert torch.allclose(sims.float(), reference, atol=1e-5)
+
+
+FEATURE_NORMS = ['softmax', 'clipped_l2norm', 'clipped', 'no_norm']
+
+
+def per_caption_scores(similarity, images, captions, lengths):
+    """
+    Reference: every caption (unpadded) attended against every image
+    with Attention and cosine_similarity, one caption at a time
+    """
+    attention = Attention(similarity.smooth, similarity.feature_norm)
+    scores = []
+    for caption, n_word in zip(captions, lengths):
+        caption = caption[:n_word].unsqueeze(0).repeat(len(images), 1, 1)
+        query, context = caption, images
+        if similarity.i2t:
+            query, context = images, caption
+        weighted, _ = attention(query, context)
+        row_sim = cosine_similarity(query, weighted, dim=2)
+        scores.append(similarity.aggregate_function(row_sim))
+    return torch.cat(scores, 1)
+
+
+@pytest.mark.parametrize('i2t', [True, False])
+@pytest.mark.parametrize('feature_norm', FEATURE_NORMS)
+@pytest.mark.parametrize('chunk_size', [1, 4, None])
+def test_stacked_attention_matches_per_caption_loop(
+    word_embeddings, i2t, feature_norm, chunk_size,
+):
+    images, captions, lengths = word_embeddings
+    # Padded word positions hold random values, they must be ignored
+    images, captions, lengths = images[:6].double(), captions[:9].double(), lengths[:9]
+    similarity = StackedAttention(
+        i2t=i2t, feature_norm=feature_norm, smooth=9,
+        agg_function='Mean', chunk_size=chunk_size,
+    )
+
+    sims = similarity(images, captions, lengths)
+    expected = per_caption_scores(similarity, images, captions, lengths)
+    assert sims.shape == (6, 9)
+    assert torch.allclose(sims, expected, rtol=0, atol=1e-9)
+
+
+def padded_pairs(lengths, max_length, seed):
+    """
+    (batch, max_length, 8) random sequences, padded positions included
+    """
+    generator = torch.Generator().manual_seed(seed)
+    padded = torch.randn(
+        len(lengths), max_length, 8, generator=generator, dtype=torch.float64,
+    )
+    return padded, lengths_to_mask(lengths, max_length)
+
+
+@pytest.mark.parametrize('feature_norm', FEATURE_NORMS)
+def test_masked_attention_matches_unpadded(feature_norm):
+    query_lens, context_lens = [3, 5, 1], [4, 2, 6]
+    query, query_mask = padded_pairs(query_lens, 5, seed=0)
+    context, context_mask = padded_pairs(context_lens, 6, seed=1)
+    attention = Attention(smooth=9, feature_norm=feature_norm)
+
+    weighted, attn = attention(
+        query, context, query_mask=query_mask, context_mask=context_mask,
+    )
+    for i, (n_query, n_context) in enumerate(zip(query_lens, context_lens)):
+        expected_weighted, expected_attn = attention(
+            query[i:i+1, :n_query], context[i:i+1, :n_context],
+        )
+        # (sourceL, queryL) weights: padded regions/words get none
+        assert (attn[i, n_context:, :n_query] == 0).all()
+        assert torch.allclose(attn[i, :n_context, :n_query], expected_attn[0])
+        assert torch.allclose(weighted[i, :n_query], expected_weighted[0])
+
+
+@pytest.mark.parametrize('feature_norm', ['softmax', 'clipped_l2norm'])
+def test_normalization_ignores_padded_queries(feature_norm):
+    attn = torch.randn(2, 4, 5, dtype=torch.float64)
+    mask = lengths_to_mask([3, 5], 5).unsqueeze(1)
+    normalize = Attention(smooth=1, feature_norm=feature_norm).normalize_attn
+
+    normalized = normalize(attn, mask)
+    assert (normalized[0, :, 3:] == 0).all()
+    assert torch.allclose(normalized[0, :, :3], normalize(attn[:1, :, :3])[0])
+    assert torch.allclose(normalized[1], normalize(attn[1:])[0])
+
+
+@pytest.mark.parametrize('i2t', [True, False])
+@pytest.mark.parametrize('feature_norm', FEATURE_NORMS)
+def test_score_pairs_ignores_padding(i2t, feature_norm):
+    region_lens, word_lens = [4, 2, 6], [3, 5, 1]
+    images, _ = padded_pairs(region_lens, 6, seed=2)
+    captions, _ = padded_pairs(word_lens, 5, seed=3)
+    similarity = StackedAttention(i2t=i2t, feature_norm=feature_norm, smooth=9)
+
+    scores = similarity.score_pairs(images, captions, word_lens, img_lens=region_lens)
+    for i, (n_region, n_word) in enumerate(zip(region_lens, word_lens)):
+        expected = similarity.score_pairs(
+            images[i:i+1, :n_region], captions[i:i+1, :n_word], [n_word],
+        )
+        assert torch.allclose(scores[i], expected[0])
@@ -0,0 +1,66 @@
+import torch
+
+from lavse.train import evaluation
+
+
+def dense_ranks(model, images, captions, lengths, shared_size):
+    sims = model.compute_pairwise_similarity(
+        model.similarity, images, captions, lengths,
+        shared_size=shared_size, async_copy=False,
+    )
+    return evaluation.i2t_ranks(sims)[0], evaluation.t2i_ranks(sims)[0]
+
+
+def test_streaming_matches_dense_with_unaligned_shards(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+
+    i2t_dense, t2i_dense = dense_ranks(
+        scan_model, images, captions, lengths, shared_size=(7, 11),
+    )
+    metrics = evaluation.evaluate_streaming(
+        scan_model, images, captions, lengths, device='cpu',
+        shared_size=(7, 11),
+    )
+
+    i2t_dense_metrics = evaluation.ranks_to_metrics(i2t_dense)
+    t2i_dense_metrics = evaluation.ranks_to_metrics(t2i_dense)
+    assert metrics['i2t_r1'] == i2t_dense_metrics[0]
+    assert metrics['t2i_r1'] == t2i_dense_metrics[0]
+    assert metrics['i2t_meanr'] == i2t_dense_metrics[4]
+    assert metrics['t2i_meanr'] == t2i_dense_metrics[4]
+
+
+def test_accumulator_matches_dense_ranks(scan_model, word_embeddings):
+    images, captions, lengths = word_embeddings
+    i2t_dense, t2i_dense = dense_ranks(
+        scan_model, images, captions, lengths, shared_size=(7, 11),
+    )
+
+    accumulator = evaluation.RankAccumulator(
+        n_images=len(images), n_captions=len(captions),
+        device='cpu', topk=0, folds=3,
+    )
+    # Ground truth sharded differently from the counted blocks
+    evaluation.compute_ground_truth(
+        scan_model.similarity, images, captions, lengths,
+        accumulator, shared_size=(4, 3),
+    )
+    for im_start, cap_start, sim in scan_model.iter_pairwise_similarity(
+        scan_model.similarity, images, captions, lengths, shared_size=(7, 11),
+    ):
+        accumulator.update(sim, im_start, cap_start)
+
+    assert torch.equal(accumulator.i2t_ranks, i2t_dense)
+    assert torch.equal(accumulator.t2i_ranks, t2i_dense)
+
+    sims = scan_model.compute_pairwise_similarity(
+        scan_model.similarity, images, captions, lengths,
+        shared_size=(7, 11), async_copy=False,
+    )
+    for (im_start, im_end, cap_start, cap_end), (i2t_fold, t2i_fold) in zip(
+        evaluation.get_fold_ranges(len(images), len(captions), 3),
+        accumulator.fold_ranks(),
+    ):
+        fold = sims[im_start:im_end, cap_start:cap_end]
+        assert torch.equal(i2t_fold, evaluation.i2t_ranks(fold)[0])
+        assert torch.equal(t2i_fold, evaluation.t2i_ranks(fold)[0])
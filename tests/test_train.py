@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from lavse.train.train import Trainer
+
+
+def get_grads(model):
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def cpu_grad_scaler(init_scale):
+    try:
+        return torch.amp.GradScaler('cpu', init_scale=init_scale)
+    except (AttributeError, RuntimeError, TypeError) as e:
+        pytest.skip(f'No CPU GradScaler ({e})')
+
+
+@pytest.mark.parametrize('grad_cache_size', [None, 8])
+def test_bfloat16_step_scales_then_unscales_gradients(
+    linear_model, linear_batch, grad_cache_size,
+):
+    model = linear_model.eval()
+    trainer = Trainer(model=model, device=torch.device('cpu'), master=False)
+    trainer.grad_cache_size = grad_cache_size
+    trainer.setup_amp('bfloat16')
+    assert trainer.amp_dtype == torch.bfloat16
+    # Loss scaling is only enabled by default for float16 on GPUs
+    assert not trainer.scaler.is_enabled()
+
+    trainer.forward_backward(linear_batch)
+    expected = get_grads(model)
+    assert all(torch.isfinite(grad).all() and grad.abs().sum() > 0 for grad in expected)
+
+    model.zero_grad()
+    trainer.scaler = cpu_grad_scaler(init_scale=2.**10)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    trainer.forward_backward(linear_batch)
+    for grad, reference in zip(get_grads(model), expected):
+        assert torch.isfinite(grad).all()
+        assert torch.allclose(grad, reference * 2**10, rtol=1e-5, atol=0)
+
+    trainer.scaler.unscale_(optimizer)
+    for grad, reference in zip(get_grads(model), expected):
+        assert torch.allclose(grad, reference, rtol=1e-5, atol=0)